@@ -1,37 +1,32 @@
 # -*- coding: utf-8 -*-
 __author__ = "Alexey Kachalov"
 
+import collections
 import logging
 import signal
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import redis
-from docker import Client as Docker
-
-from craftengine.modules import KernelModuleSingleton
+from craftengine.modules import KernelModuleSingleton, LazyModule
 from craftengine.exceptions import KernelException
-from craftengine import (
-    registry,
-    service,
-    rpc,
-)
 
 
 class Kernel(KernelModuleSingleton):
     alive = None
+    timeline = None
+    startup = None
     _env = None
-    redis_l = None
-    redis_g = None
-    l = None
-    g = None
-    service = None
-    rpc = None
+    _started = None
+    _stopped = None
     node = None
-    docker = None
 
     def init(self, *args, **kwargs):
         self.alive = True
+        self._started = time.monotonic()
+        self._stopped = threading.Event()
+        self.timeline = []
+        self.startup = collections.OrderedDict()
         threading.current_thread().setName("kernel")
         self._env = {}
         for k, v in kwargs.items():
@@ -43,21 +38,40 @@ class Kernel(KernelModuleSingleton):
         signal.signal(signal.SIGTERM, self.exit)
         signal.signal(signal.SIGINT, self.exit)
         signal.signal(signal.SIGPWR, self.exit)
+        signal.signal(signal.SIGUSR2, self.handoff)
 
-        self.redis_l = redis.Redis(
+    @LazyModule
+    def redis_l(self):
+        import redis
+        return redis.Redis(
             host=self.env.get("REDIS_HOST", "redis"),
             port=int(self.env.get("REDIS_PORT", 6379)),
             db=int(self.env.get("REDIS_DB", 0)),
             password=self.env.get("REDIS_PASSWORD", None),
         )
-        self.l = registry.Local()
+
+    @LazyModule
+    def redis_g(self):
+        import redis
+        redis_g = self.l.get("kernel/env", keys=["REDIS_HOST", "REDIS_PORT", "REDIS_DB", "REDIS_PASSWORD"])
+        return redis.Redis(
+            host=redis_g["REDIS_HOST"],
+            port=redis_g["REDIS_PORT"],
+            db=redis_g["REDIS_DB"],
+            password=redis_g["REDIS_PASSWORD"],
+        )
+
+    @LazyModule
+    def l(self):
+        from craftengine import registry
+        l = registry.Local()
 
         for key, t in {
             "kernel/env": "hash",
             "kernel/services": "hash",
         }.items():
             try:
-                self.l.create(key, data_type=t, handler=None, handler_lua="""\
+                l.create(key, data_type=t, handler=None, handler_lua="""\
 function(method, key, data)
     if method == "get" then
         return true
@@ -68,66 +82,186 @@ end\
 """)
             except registry.ConsistencyException:
                 pass
+        return l
 
-        redis_g = self.l.get("kernel/env", keys=["REDIS_HOST", "REDIS_PORT", "REDIS_DB", "REDIS_PASSWORD"])
-        self.redis_g = redis.Redis(
-            host=redis_g["REDIS_HOST"],
-            port=redis_g["REDIS_PORT"],
-            db=redis_g["REDIS_DB"],
-            password=redis_g["REDIS_PASSWORD"],
-        )
-        self.g = registry.Global()
-
-        self.service = service.Service()
-
-        self.rpc = rpc.Rpc()
+    @LazyModule
+    def g(self):
+        from craftengine import registry
+        g = registry.Global()
 
         try:
-            self.kernel.g.create("kernel/nodes", data_type="hash")
+            g.create("kernel/nodes", data_type="hash")
         except registry.ConsistencyException:
             pass
-        # self.kernel.g.set("kernel/nodes", keys={self.kernel.env["CE_NODE_NAME"]: self.rpc.real_host})
+        # g.set("kernel/nodes", keys={self.env["CE_NODE_NAME"]: self.rpc.real_host})
+        return g
+
+    @LazyModule
+    def event(self):
+        from craftengine import event
+        return event.Event()
 
-        self.docker = Docker(base_url="unix://var/run/docker.sock")
+    @LazyModule
+    def permissions(self):
+        from craftengine import permissions
+        return permissions.Permissions()
+
+    @LazyModule
+    def limits(self):
+        from craftengine import limits
+        return limits.Limits()
+
+    @LazyModule
+    def api(self):
+        from craftengine import api
+        return api.Api()
+
+    @LazyModule
+    def service(self):
+        from craftengine import service
+        return service.Service()
+
+    @LazyModule
+    def watcher(self):
+        from craftengine import watcher
+        return watcher.Watcher()
+
+    @LazyModule
+    def stats(self):
+        from craftengine import stats
+        return stats.Stats()
+
+    @LazyModule
+    def profiler(self):
+        from craftengine import profiler
+        return profiler.Profiler()
+
+    @LazyModule
+    def rpc(self):
+        from craftengine import rpc
+        return rpc.Rpc()
+
+    @LazyModule
+    def docker(self):
+        from docker import Client as Docker
+        return Docker(base_url="unix://var/run/docker.sock")
 
     def exit(self, *args, **kwargs):
+        """
+        :param handoff: connections have been handed over to a new kernel, services keep running
+        """
+        handoff = kwargs.pop("handoff", False)
         if not self.alive:
             return
-        self._alive = False
+        self.alive = False
+        self._stopped.set()
 
         try:
             logging.info("Stopping kernel...")
             super().exit(*args, **kwargs)
 
-            lst = self.service.list()
-            for k, v in lst.items():
-                self.service.stop(k)
+            service = LazyModule.loaded(self, "service")
+            if service is not None and not handoff:
+                for result in service.stop_all():
+                    if not result["success"]:
+                        logging.error("Could not stop '%s'[%i]: %s" % (result["service"], result["instance"], result["error"]))
 
-            self.rpc.exit(*args, **kwargs)
+            # Modules never accessed are not loaded just to be stopped
+            for name in ["service", "watcher", "api", "event", "rpc", "stats"]:
+                module = LazyModule.loaded(self, name)
+                if module is not None:
+                    module.exit(*args, **kwargs)
         except Exception as e:
             logging.exception(e)
             self.alive = True
 
+    def handoff(self, *args, **kwargs):
+        """
+        Drain connections and hand them over to a new kernel process started with the same CE_HANDOFF
+        """
+        path = self.env.get("CE_HANDOFF")
+        rpc = LazyModule.loaded(self, "rpc")
+        if path is None or rpc is None:
+            logging.warning("Handoff requested, but CE_HANDOFF isn't set or RPC isn't started")
+            return
+        rpc.call_soon(rpc.drain, path, lambda: self.exit(handoff=True))
+
+    def mark(self, stage):
+        """
+        Add stage to startup timeline
+        """
+        self.timeline.append((stage, time.monotonic() - self._started))
+
     def serve(self):
+        self.mark("init")
         threading.Thread(target=self.rpc.serve, name="kernel.rpc").start()
-        while self.alive and self.rpc.alive is None:
-            time.sleep(0.1)
+        self.rpc.ready.wait()
 
         if not self.rpc.alive:
             raise KernelException("RPC Server start failed")
+        self.mark("rpc")
 
-        for node in self.g.get("kernel/nodes").keys():
-            if node == self.rpc.router.name:
-                continue
+        self.watcher.serve()
 
-            self.rpc.node(node)
+        if self.env.get("CE_METRICS_PORT") is not None:
+            self.stats.serve_http(self.env.get("CE_METRICS_HOST", "0.0.0.0"), self.env["CE_METRICS_PORT"])
 
-        lst = self.service.list()
-        for k, v in lst.items():
-            self.service.start(k, num=v.get("scale", 1))
+        if self.rpc.adopted:
+            # Services and node links have been handed over by the previous kernel
+            services = self.service.list()
+            self.permissions.load(services)
+            self.limits.load(services)
+            self.mark("ready")
+        else:
+            self.bootstrap()
+
+        logging.info("Kernel started in %.3fs (%s)" % (
+            self.timeline[-1][1],
+            ", ".join("%s %.3fs" % stage for stage in self.timeline),
+        ))
+        logging.info("Kernel modules loaded in %s" % self.startup_report())
 
         while self.alive and self.rpc.alive:
-            time.sleep(1)
+            self._stopped.wait(1)
+
+    def bootstrap(self):
+        """
+        Connect to other nodes and start services
+        """
+        nodes = [node for node in self.g.get("kernel/nodes").keys() if node != self.rpc.router.name]
+        services = self.service.list()
+        with ThreadPoolExecutor(max_workers=max(len(nodes) + len(services), 1), thread_name_prefix="kernel.bootstrap") as pool:
+            nodes_futures = [pool.submit(self.rpc.node, node) for node in nodes]
+            services_futures = [
+                pool.submit(self.service.start, k, num=v.get("scale", 1))
+                for k, v in services.items()
+            ]
+
+            connected = sum(1 for future in nodes_futures if future.result())
+            self.mark("nodes")
+            if connected < len(nodes):
+                logging.warning("Connected to %i of %i nodes" % (connected, len(nodes)))
+
+            expected = set()
+            for (service, _), future in zip(services.items(), services_futures):
+                for result in future.result():
+                    if result["success"]:
+                        expected.add((service, result["instance"]))
+                    else:
+                        logging.error("Could not start '%s'[%i]: %s" % (service, result["instance"], result["error"]))
+            self.mark("services")
+
+        handler = self.rpc.router.get_handler(self.rpc.router.SOCK_SERVICE)
+        missing = handler.wait_instances(expected, float(self.env.get("CE_READY_TIMEOUT", 30)))
+        self.mark("ready")
+        if len(missing) > 0:
+            logging.warning("Service instances not connected: %s" % ", ".join("'%s'[%i]" % i for i in sorted(missing)))
+
+    def startup_report(self):
+        """
+        Load time of each kernel module, including modules it has loaded
+        """
+        return ", ".join("%s %.3fs" % module for module in self.startup.items())
 
     @property
     def env(self):
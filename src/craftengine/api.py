@@ -1,22 +1,11 @@
 # -*- coding: utf-8 -*-
 __author__ = "Alexey Kachalov"
 
-"""
-========================================
-ATTENTION!
-
-HAVE TO REFACTOR
-========================================
-"""
-
 import logging
-import traceback
-import time
-import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from craftengine.exceptions import ModuleException
-import craftengine
-from craftengine import event
+from craftengine.modules import KernelModule
 
 
 class ApiException(ModuleException):
@@ -31,179 +20,171 @@ class AuthException(ApiException):
     pass
 
 
-class Api(object):
-    proxy_property = lambda x: lambda *args, **kwargs: x
-    proxy_method = lambda x: lambda request, plugin, *args, **kwargs: x(*args, **kwargs)
+class Api(KernelModule):
+    """
+    Methods the kernel serves to services
+    Each method is called as function(principal, *args, **kwargs), principal is the caller's address
+    """
+
+    # Registry keys of the kernel hold service and node tokens, services never access them
+    KERNEL_KEYS = "kernel/"
+    # Registry arguments only the kernel passes: trusted skips access handlers,
+    # handlers would run code of the caller inside the kernel
+    KERNEL_KWARGS = ("trusted", "handler", "handler_lua")
+
+    proxy_property = staticmethod(lambda x: lambda principal, *args, **kwargs: x)
+    proxy_method = staticmethod(lambda x: lambda principal, *args, **kwargs: x(*args, **kwargs))
+
+    # method -> (function, required permissions parts, inline)
+    _methods = None
+    _executor = None
 
-    @staticmethod
-    def bind(name, method, perms=None):
+    def init(self, *args, **kwargs):
+        self._methods = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(self.kernel.env.get("CE_API_WORKERS", 8)),
+            thread_name_prefix="kernel.api",
+        )
+
+        self.bind("logger.log", self.proxy_method(logging.log))
+        self.bind("logger.debug", self.proxy_method(logging.debug))
+        self.bind("logger.info", self.proxy_method(logging.info))
+        self.bind("logger.warning", self.proxy_method(logging.warning))
+        self.bind("logger.error", self.proxy_method(logging.error))
+        self.bind("logger.critical", self.proxy_method(logging.critical))
+        self.bind("env", self.proxy_property(self.kernel.env), "kernel.env")
+
+        for ns, registry in [
+            ("local", lambda: self.kernel.l),
+            ("global", lambda: self.kernel.g),
+        ]:
+            for m in ["create", "get", "set", "rem"]:
+                name = "registry.%s.%s" % (ns, m)
+                self.bind(name, self.registry_method(registry, m), name)
+            name = "registry.%s.mget" % ns
+            self.bind(name, self.registry_mget(registry), "registry.%s.get" % ns)
+
+        self.bind("event.register", self.event_register, "event.register")
+        self.bind("event.unregister", self.event_unregister, "event.register")
+        self.bind("event.initiate", self.proxy_method(self.kernel.event.initiate), "event.initiate")
+        self.bind("event.info", self.proxy_method(self.kernel.event.info), "event.info")
+
+        # Router state is only touched from the RPC thread
+        self.bind("stats", self.proxy_method(self.kernel.stats.snapshot), "kernel.stats", inline=True)
+        self.bind("profile", self.proxy_method(self.kernel.profiler.configure), "kernel.profile", inline=True)
+
+        self.bind("service.list", self.service_list, "kernel.service.list")
+        self.bind("service.states", self.proxy_method(self.kernel.watcher.states), "kernel.service.list")
+        self.bind("service.start", self.proxy_method(self.kernel.service.start), "kernel.service.start")
+        self.bind("service.stop", self.proxy_method(self.kernel.service.stop), "kernel.service.stop")
+        self.bind("service.scale", self.proxy_method(self.kernel.service.scale), "kernel.service.scale")
+
+    def bind(self, name, function, perms=None, inline=False):
+        """
+        Add method to the dispatch table
+        :param perms: required permission or list of them
+        :param inline: method doesn't block, called from the RPC thread
+        """
         perms = [] if perms is None else perms
         if not isinstance(perms, list):
             perms = [perms]
-        registry.Registry().hset("api.methods", name, (method, perms))
+        self._methods[name] = (function, tuple(self.kernel.permissions.split(perm) for perm in perms), inline)
 
-    @staticmethod
-    def execute(data, request):
-        exc_methods = ["auth"]
-        identificator = None
+    def get(self, method):
+        """
+        :return: (function, inline)
+        :raise: ApiException
+        """
         try:
-            method, args, kwargs, identificator = data[:4]
-
-            plugin = None
-            if method not in exc_methods:
-                try:
-                    pls = registry.Registry().get("api.authed")
-                    plugin = pls[request.fileno]
-                except KeyError:
-                    raise AuthException
-
-            function, perms_reqs = registry.Registry().hget("api.methods", method)
-            if method not in exc_methods:
-                pls = registry.GlobalRegistry().get("kernel.plugins")
-                for pli in pls.values():
-                    if pli["name"] == plugin:
-                        pl = pli
-                threading.current_thread().setName(pl["name"])
-                Api.has_permission(pl["permissions"], perms_reqs)
-
-            data = function(request, plugin, *args, **kwargs)
-        except Exception as e:
-            error = [
-                "%s.%s" % (
-                    getattr(e, "__module__", "__built_in__"),
-                    e.__class__.__name__,
-                ),
-                str(e),
-                traceback.format_exc(),
-            ]
-            data = []
-            logging.exception(e)
-        else:
-            error = []
-
-        if identificator is None:
-            return None
-
-        return identificator, error, data
-
-    @staticmethod
-    def request(node, service, plugin, method, args=None, kwargs=None, callback=None):
-        args = () if args is None else args
-        kwargs = {} if kwargs is None else kwargs
-        identificator = None if callback is None else "%s:%s" % (service, time.time())
-        request = [
-            node,
-            service,
-            method,
-            args,
-            kwargs,
-            identificator,
-        ]
-
-        if identificator is not None:
-            registry.Registry().hset("api.requests", identificator, callback)
-
-        fn = registry.Registry().hget("api.plugins", plugin)
-        cli = registry.Registry().hget("api.pool", fn[0])
-        cli.response.append(request)
-        cli.stream(cli.STREAMOUT)
-        return identificator
-
-    @staticmethod
-    def response(data):
-        try:
-            callback = registry.Registry().hget("api.requests", data[0])
+            function, _, inline = self._methods[method]
         except KeyError:
-            return
+            raise ApiException("Unknown method: %s" % method)
+        return function, inline
 
-        err_handler = lambda err, id: logging.error("%s: %s\nTraceback: %s", *err)
-        if isinstance(callback, tuple):
-            callback, err_handler = callback
+    def methods(self):
+        return self._methods.keys()
 
+    def check(self, service, method):
+        """
+        Check service may call method
+        :raise: ApiException, PermissionException
+        """
         try:
-            if len(data[1]) == 0:
-                callback(data[2], data[0])
-            else:
-                err_handler(data[1], data[0])
-        except:
-            logging.exception("Could not process response")
-
-
-def kernel_auth(request, p, plugin, token):
-    pl = None
-    pls = registry.GlobalRegistry().get("kernel.plugins")
-    for pli in pls.values():
-        if pli["name"] == plugin:
-            pl = pli
-
-    if pl is None:
-        return False
-
-    if pl["token"] == token:
-        with registry.Registry()._lock:
+            function, reqs, _ = self._methods[method]
+        except KeyError:
+            raise ApiException("Unknown method: %s" % method)
+
+        if len(reqs) > 0:
+            compiled = self.kernel.permissions.principal(service)[0]
+            for req in reqs:
+                if not self.kernel.permissions.granted(compiled, req):
+                    raise PermissionException(".".join(req))
+        return function
+
+    def submit(self, function, principal, args, kwargs, callback):
+        """
+        Call method on the worker pool
+        :param callback: callable(result, exception)
+        """
+        def call():
             try:
-                a = registry.Registry().hget("api.plugins", pl["name"])
-            except KeyError:
-                a = []
-            a.append(request.fileno)
-            registry.Registry().hset("api.plugins", pl["name"], a)
-        registry.Registry().hset("api.authed", request.fileno, pl["name"])
-        return True
-    else:
-        return False
-
-
-def event_register(request, plugin, *args, **kwargs):
-    if len(args) > 1:
-        args = (args[0],) + ((args[1], request, plugin),) + tuple(*args[2:])
-
-    if "callback" in kwargs.keys():
-        kwargs["callback"] = kwargs["callback"], request, plugin
-
-    return event.Event().register(*args, **kwargs)
-
-Api.bind("auth", kernel_auth)
-Api.bind("logger.log", Api.proxy_method(logging.log))
-Api.bind("logger.debug", Api.proxy_method(logging.debug))
-Api.bind("logger.info", Api.proxy_method(logging.info))
-Api.bind("logger.warning", Api.proxy_method(logging.warning))
-Api.bind("logger.error", Api.proxy_method(logging.error))
-Api.bind("logger.critical", Api.proxy_method(logging.critical))
-Api.bind(
-    "env",
-    Api.proxy_property(craftengine.Kernel().env),
-    "kernel.env"
-)
-
-for ns in [
-    "local",
-    "global",
-    "permanent",
-]:
-    for m in [
-        "get",
-        "set",
-        "delete",
-        "stack",
-        "rpush",
-        "rpop",
-        "lpush",
-        "lpop",
-        "hash",
-        "hget",
-        "hset",
-        "hdelete",
-    ]:
-        Api.bind(
-            "registry.%s.%s" % (ns, m),
-            Api.proxy_method(registry.Registry().__getattribute__(m)),
-            "registry.%s.%s"
-        )
-
-Api.bind(
-    "event.register",
-    event_register,
-    "event.register"
-)
-Api.bind("event.initiate", Api.proxy_method(event.Event().initiate), "event.initiate")
-Api.bind("event.info", Api.proxy_method(event.Event().info), "event.info")
+                result = function(principal, *(args or ()), **(kwargs or {}))
+            except Exception as e:
+                callback(None, e)
+            else:
+                callback(result, None)
+        self._executor.submit(call)
+
+    @classmethod
+    def check_key(cls, key):
+        """
+        :raise: PermissionException
+        """
+        if str(key).startswith(cls.KERNEL_KEYS):
+            raise PermissionException("Registry key is reserved by the kernel: %s" % key)
+
+    @classmethod
+    def registry_method(cls, registry, name):
+        def method(principal, key, **kwargs):
+            cls.check_key(key)
+            for name in cls.KERNEL_KWARGS:
+                kwargs.pop(name, None)
+            return getattr(registry(), name)(key, **kwargs)
+        return method
+
+    @classmethod
+    def registry_mget(cls, registry):
+        def method(principal, keys, **kwargs):
+            for key in keys:
+                cls.check_key(key)
+            for name in cls.KERNEL_KWARGS:
+                kwargs.pop(name, None)
+            return {key: registry().get(key, **kwargs) for key in keys}
+        return method
+
+    def service_list(self, principal):
+        """
+        Services of the node without their tokens
+        """
+        return {
+            service: {k: v for k, v in service_info.items() if k != "token"}
+            for service, service_info in self.kernel.service.list().items()
+        }
+
+    def event_register(self, principal, name, method, namespace=None):
+        """
+        Subscribe the calling instance's method to event
+        """
+        _, service, instance = principal
+        return self.kernel.event.register(name, (service, instance, method), namespace=namespace)
+
+    def event_unregister(self, principal, name, cid):
+        """
+        Unsubscribe callback registered by the calling instance
+        """
+        _, service, instance = principal
+        return self.kernel.event.unregister(name, cid, owner=(service, instance))
+
+    def exit(self, *args, **kwargs):
+        super().exit(*args, **kwargs)
+        self._executor.shutdown(wait=False)
@@ -1,10 +1,107 @@
 # -*- coding: utf-8 -*-
 __author__ = "Alexey Kachalov"
 
+import collections
+import itertools
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from craftengine.exceptions import ModuleException
 from craftengine.modules import KernelModule
-from craftengine.exceptions import KernelException
+from craftengine.rpc import ServiceHandler, NodeHandler
+
+
+class EventException(ModuleException):
+    pass
+
+
+class Subscriptions(object):
+    """
+    Trie of dotted event name patterns
+    "*" matches one part of the name, "**" matches any number of parts
+    """
+
+    ONE = "*"
+    ANY = "**"
+
+    CACHE_SIZE = 1024
+
+    __slots__ = ("children", "callbacks", "_cache")
+
+    def __init__(self):
+        self.children = {}
+        # callback id -> callback entry
+        self.callbacks = {}
+        self._cache = {}
+
+    def add(self, pattern, cid, entry):
+        node = self
+        for part in pattern.split("."):
+            node = node.children.setdefault(part, Subscriptions())
+        node.callbacks[cid] = entry
+        self._cache.clear()
+
+    def remove(self, pattern, cid):
+        path = [self]
+        for part in pattern.split("."):
+            node = path[-1].children.get(part)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].callbacks.pop(cid, None)
+        self._cache.clear()
+
+        # Drop branches left without callbacks
+        for parent, part, node in reversed(list(zip(path, pattern.split("."), path[1:]))):
+            if len(node.callbacks) > 0 or len(node.children) > 0:
+                break
+            del parent.children[part]
+
+    def get(self, pattern):
+        """
+        Callbacks registered exactly for the pattern
+        """
+        node = self
+        for part in pattern.split("."):
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node.callbacks if len(node.callbacks) > 0 else None
+
+    def match(self, name):
+        """
+        Callbacks of all patterns matching the event name
+        :return: list of callback entries
+        """
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+
+        result = {}
+        self._match(name.split("."), 0, result)
+        result = list(result.values())
+        if len(self._cache) >= self.CACHE_SIZE:
+            self._cache.clear()
+        self._cache[name] = result
+        return result
+
+    def _match(self, parts, i, result):
+        deep = self.children.get(self.ANY)
+        if deep is not None:
+            for j in range(i, len(parts) + 1):
+                deep._match(parts, j, result)
+
+        if i == len(parts):
+            result.update(self.callbacks)
+            return
+
+        for part in (parts[i], self.ONE):
+            node = self.children.get(part)
+            if node is not None:
+                node._match(parts, i + 1, result)
 
 
 class Event(KernelModule):
@@ -23,58 +120,216 @@ class Event(KernelModule):
     #
     N_GLOBAL = 3
 
+    # Sender of event requests delivered to services
+    SENDER = "__kernel__"
+
     _callbacks = None
+    _ids = None
+    _events = None
+    _executor = None
+    _outbox = None
+    _global_outbox = None
+    _seen = None
+    _seen_size = None
+    _lock = None
+
+    node = None
+    _prefix = None
 
     def init(self, *args, **kwargs):
-        self._callbacks = {}
+        self.node = self.kernel.env.get("CE_NODE_NAME")
+        # Ids of a restarted kernel must not match ids remembered by other nodes
+        self._prefix = "%s:%x" % (self.node, int(time.time() * 1000))
+        # pattern -> {callback id: (callback, has_permission, namespace)}
+        self._callbacks = Subscriptions()
+        self._ids = itertools.count(1)
+        self._events = itertools.count(1)
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(self.kernel.env.get("CE_EVENT_WORKERS", 4)),
+            thread_name_prefix="kernel.event",
+        )
+        # (service, instance) -> [frame, ...]
+        self._outbox = {}
+        # [(eid, name, data, visited), ...] to be sent to other nodes
+        self._global_outbox = []
+        # Ids of recent global events, to deliver each of them once
+        self._seen = collections.OrderedDict()
+        self._seen_size = int(self.kernel.env.get("CE_EVENT_SEEN", 10000))
+        self._lock = threading.Lock()
 
     def _add_callback(self, name, callback, has_permission, namespace):
-        if name not in self._callbacks.keys():
-            self._callbacks[name] = []
-        self._callbacks[name].append((callback, has_permission, namespace))
-        return len(self._callbacks[name]) - 1
+        cid = next(self._ids)
+        with self._lock:
+            self._callbacks.add(name, cid, (callback, has_permission, namespace))
+        return cid
 
     def _has_permission(self, name, namespace):
         return True
 
     def register(self, name, callback, namespace=None, has_permission=None):
+        """
+        Register event callback
+        :param name: dotted event name, parts may be "*" or "**" wildcards
+        :param callback: callable(name, data) or service method as (service, instance, method),
+            instance None delivers to a balanced instance
+        :return: callback id
+        """
         namespace = namespace if namespace is not None else self.N_PLUGIN
         has_permission = has_permission if has_permission is not None else self._has_permission
+        if not callable(callback):
+            service, instance, method = callback
+            callback = (service, instance, method)
         return self._add_callback(name, callback, has_permission, namespace)
 
+    def unregister(self, name, cid, owner=None):
+        """
+        :param owner: (service, instance) the callback has to be registered for
+        :raise: EventException
+        """
+        with self._lock:
+            if owner is not None:
+                callback = (self._callbacks.get(name) or {}).get(cid, (None,))[0]
+                if callback is None or callable(callback) or tuple(callback[:2]) != tuple(owner):
+                    raise EventException("Callback %s of `%s` isn't registered by the caller" % (cid, name))
+            self._callbacks.remove(name, cid)
+
     def initiate(self, name, data=None, namespace=None):
         """
-        Initiate event
+        Initiate event, callbacks are called asynchronously
         :param name: name of event
         :param data: data passing to callback
         :param namespace: namespace of event
-        :return: None
+        :return: event id
         """
         namespace = namespace if namespace is not None else self.N_PLUGIN
-        try:
-            callbacks = self._callbacks[name]
-        except KeyError:
-            return data
+        eid = "%s:%i" % (self._prefix, next(self._events))
+        if namespace == self.N_GLOBAL:
+            self._is_seen(eid)
+            self._propagate(eid, name, data, [self.node])
+        self._deliver(name, data, namespace)
+        return eid
+
+    def receive(self, eid, name, data, visited):
+        """
+        Global event from another node, called from the RPC thread
+        :param visited: nodes the event has already been sent to
+        """
+        if self._is_seen(eid):
+            return
+        self._propagate(eid, name, data, visited)
+        self._deliver(name, data, self.N_GLOBAL)
 
+    def _is_seen(self, eid):
+        with self._lock:
+            if eid in self._seen:
+                return True
+            self._seen[eid] = None
+            if len(self._seen) > self._seen_size:
+                self._seen.popitem(last=False)
+            return False
+
+    def _deliver(self, name, data, namespace):
+        with self._lock:
+            callbacks = self._callbacks.match(name)
+        if len(callbacks) > 0:
+            self._executor.submit(self._dispatch, name, data, namespace, callbacks)
+
+    def _dispatch(self, name, data, namespace, callbacks):
+        frames = {}
         for callback, has_permission, cb_namespace in callbacks:
             if namespace > cb_namespace:
                 continue
 
-            if has_permission(name, namespace) is True:
-                try:
-                    callback, req, pl = callback
-                    # Call
-                except Exception as e:
-                    logging.exception(e)
+            try:
+                if has_permission(name, namespace) is not True:
+                    continue
+                if callable(callback):
+                    callback(name, data)
+                else:
+                    service, instance, method = callback
+                    frames.setdefault((service, instance), []).append([
+                        ServiceHandler.PROCESS_REQUEST,
+                        [self.node, self.SENDER, None],
+                        method,
+                        [name, data],
+                        None,
+                        None,
+                    ])
+            except Exception as e:
+                logging.exception(e)
 
-        if namespace == self.N_GLOBAL:
-            raise KernelException("NIY")
+        if len(frames) > 0:
+            with self._lock:
+                flush = len(self._outbox) == 0
+                for target, target_frames in frames.items():
+                    self._outbox.setdefault(target, []).extend(target_frames)
+            # Events fired until the RPC thread picks the outbox up go out together
+            if flush:
+                self.kernel.rpc.call_soon(self._flush)
+
+    def _flush(self):
+        """
+        Queue collected event frames to their services, called from the RPC thread
+        """
+        with self._lock:
+            outbox, self._outbox = self._outbox, {}
+
+        handler = self.kernel.rpc.router.get_handler(self.kernel.rpc.router.SOCK_SERVICE)
+        for (service, instance), frames in outbox.items():
+            try:
+                handler.notify(service, instance, frames)
+            except Exception as e:
+                logging.debug("Events to `%s` dropped: %s" % (service, e))
+
+    def _propagate(self, eid, name, data, visited):
+        with self._lock:
+            flush = len(self._global_outbox) == 0
+            self._global_outbox.append((eid, name, data, visited))
+        if flush:
+            self.kernel.rpc.call_soon(self._flush_global)
+
+    def _flush_global(self):
+        """
+        Send collected global events to connected nodes, one frame per link, called from the RPC thread
+        """
+        with self._lock:
+            outbox, self._global_outbox = self._global_outbox, []
+
+        handler = self.kernel.rpc.router.get_handler(self.kernel.rpc.router.SOCK_NODE)
+        nodes = set(handler.nodes())
+        frames = {}
+        for eid, name, data, visited in outbox:
+            targets = nodes.difference(visited)
+            if len(targets) == 0:
+                continue
+            # Receivers don't forward the event to nodes this node sends it to
+            visited = list(set(visited).union(targets))
+            for node in targets:
+                frames.setdefault(node, []).append([eid, name, data, visited])
+
+        for node, events in frames.items():
+            try:
+                handler.send(node, [NodeHandler.PROCESS_EVENTS, events])
+            except Exception as e:
+                logging.debug("Events to node `%s` dropped: %s" % (node, e))
 
     def info(self, name):
-        try:
-            callback, has_permission, namespace = self._callbacks[name]
-            return {
-                "namespace": namespace,
-            }
-        except KeyError:
-            return False
+        """
+        Callbacks registered for the event name pattern
+        """
+        with self._lock:
+            callbacks = self._callbacks.get(name)
+            if callbacks is None:
+                return False
+            return [
+                {
+                    "id": cid,
+                    "namespace": namespace,
+                    "target": None if callable(callback) else list(callback),
+                }
+                for cid, (callback, _, namespace) in callbacks.items()
+            ]
+
+    def exit(self, *args, **kwargs):
+        super().exit(*args, **kwargs)
+        self._executor.shutdown(wait=False)
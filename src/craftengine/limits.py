@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+__author__ = "Alexey Kachalov"
+
+import threading
+import time
+
+from craftengine.exceptions import ModuleException
+from craftengine.modules import KernelModule
+
+
+class LimitsException(ModuleException):
+    pass
+
+
+class RateLimitException(LimitsException):
+    pass
+
+
+class TokenBucket(object):
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst=None, now=None):
+        """
+        :param rate: tokens per second
+        :param burst: bucket size, one second of rate by default
+        :param now: monotonic time the bucket is full at
+        """
+        self.rate = float(rate)
+        self.burst = max(float(rate if burst is None else burst), 1.0)
+        self.tokens = self.burst
+        self.stamp = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        self.tokens = min(self.tokens + (now - self.stamp) * self.rate, self.burst)
+        self.stamp = now
+        return self.tokens >= 1
+
+
+class Limits(KernelModule):
+    """
+    Request rate limits of services, from "limits" of their kernel/services entries:
+    {"rate": 1000, "burst": 2000, "callers": {"caller": {"rate": 100}, "*": {"rate": 10}}}
+    "rate" and "burst" limit all requests to the service, "callers" limit each caller, "*" is for other callers
+    """
+
+    # service -> limits
+    _limits = None
+    # service -> bucket
+    _services = None
+    # (caller, service) -> bucket
+    _callers = None
+    # Services data is loaded on the executor and saved from other threads, requests are admitted on the RPC thread
+    _lock = None
+
+    def init(self, *args, **kwargs):
+        self._lock = threading.Lock()
+        self._limits = {}
+        self._services = {}
+        self._callers = {}
+
+    def load(self, services):
+        """
+        Buckets of services whose limits haven't changed are kept
+        :param services: kernel/services data
+        """
+        with self._lock:
+            for service in set(self._limits.keys()).union(services.keys()):
+                self._update(service, services.get(service) or {})
+
+    def update(self, service, service_info):
+        with self._lock:
+            self._update(service, service_info)
+
+    def _update(self, service, service_info):
+        limits = service_info.get("limits") or None
+        if limits == self._limits.get(service):
+            return
+        if limits is None:
+            self._limits.pop(service, None)
+        else:
+            self._limits[service] = limits
+        self._services.pop(service, None)
+        for key in [key for key in self._callers.keys() if key[1] == service]:
+            del self._callers[key]
+
+    def _bucket(self, buckets, key, limits, now):
+        bucket = buckets.get(key)
+        if bucket is None and limits is not None and limits.get("rate") is not None:
+            bucket = buckets[key] = TokenBucket(limits["rate"], limits.get("burst"), now)
+        return bucket
+
+    def admit(self, caller, service):
+        """
+        Take a token for the request, both caller's and service's buckets have to allow it
+        :raise: RateLimitException
+        """
+        with self._lock:
+            self._admit(caller, service)
+
+    def _admit(self, caller, service):
+        limits = self._limits.get(service)
+        if limits is None:
+            return
+
+        now = time.monotonic()
+        callers = limits.get("callers") or {}
+        caller_bucket = self._bucket(self._callers, (caller, service), callers.get(caller, callers.get("*")), now)
+        if caller_bucket is not None and not caller_bucket.refill(now):
+            raise RateLimitException("Rate limit of `%s` for `%s` exceeded" % (service, caller))
+
+        service_bucket = self._bucket(self._services, service, limits, now)
+        if service_bucket is not None and not service_bucket.refill(now):
+            raise RateLimitException("Rate limit of `%s` exceeded" % service)
+
+        if caller_bucket is not None:
+            caller_bucket.tokens -= 1
+        if service_bucket is not None:
+            service_bucket.tokens -= 1
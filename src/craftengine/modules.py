@@ -2,6 +2,8 @@
 __author__ = "Alexey Kachalov"
 
 import logging
+import threading
+import time
 
 
 class KernelModule(object):
@@ -10,7 +12,7 @@ class KernelModule(object):
     alive = property(fget=lambda self: self._alive)
 
     def __init__(self, *args, **kwargs):
-        logging.debug("Loading kernel module: %s" % self.__class__.__name__)
+        logging.debug("Loading kernel module: %s", self.__class__.__name__)
         from craftengine import Kernel
         self.kernel = Kernel()
         self.init(*args, **kwargs)
@@ -28,7 +30,7 @@ class KernelModule(object):
         """
 
     def exit(self, *args, **kwargs):
-        logging.debug("Unloading kernel module: %s" % self.__class__.__name__)
+        logging.debug("Unloading kernel module: %s", self.__class__.__name__)
         self._alive = False
 
 
@@ -46,3 +48,40 @@ class KernelModuleSingleton(KernelModule):
             return
         self.__class__._no_init = True
         super().__init__(*args, **kwargs)
+
+
+class LazyModule(object):
+    """
+    Kernel attribute created by decorated loader on first access
+    """
+
+    # Single lock for all loaders, as they load each other
+    _lock = threading.RLock()
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.name = loader.__name__
+        self.__doc__ = loader.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        with self._lock:
+            # Loaded by another thread while waiting for lock
+            if self.name in instance.__dict__:
+                return instance.__dict__[self.name]
+
+            started = time.perf_counter()
+            value = self.loader(instance)
+            instance.__dict__[self.name] = value
+            instance.startup[self.name] = time.perf_counter() - started
+        return value
+
+    @staticmethod
+    def loaded(instance, name):
+        """
+        Get attribute only if already loaded
+        :return: value or None
+        """
+        return instance.__dict__.get(name)
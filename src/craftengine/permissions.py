@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 __author__ = "Alexey Kachalov"
 
+from types import MappingProxyType
 
 from craftengine.exceptions import ModuleException
 from craftengine.modules import KernelModule
@@ -11,25 +12,81 @@ class PermissionsException(ModuleException):
 
 
 class Permissions(KernelModule):
+    """
+    Permissions are dotted names, "*" part grants everything below it
+    Permission lists are compiled into immutable tries, where True grants the whole subtree
+    """
+
+    CACHE_SIZE = 4096
+
+    _compiled = None
+    _reqs = None
+    # (service, method) -> required permission parts
+    _routes = None
+    # service -> (compiled permissions, protected, permissions)
+    _principals = None
+    _loaded = False
+
+    # Principal of unknown services
+    NOBODY = (MappingProxyType({}), False, ())
+
+    def init(self, *args, **kwargs):
+        self._compiled = {}
+        self._reqs = {}
+        self._routes = {}
+        self._principals = {}
+
     def perms_merger(self, perms):
         merged = {}
         for perm in perms:
-            if len(perm) == 0:
-                merged["*"] = True
-                continue
-            if perm[0] not in merged.keys():
-                merged[perm[0]] = []
+            # Permission ends here or continues with "*": whole subtree
+            if len(perm) == 0 or perm[0] == "*":
+                return True
+            merged.setdefault(perm[0], []).append(perm[1:])
+
+        return MappingProxyType({k: self.perms_merger(v) for k, v in merged.items()})
+
+    def compile(self, perms):
+        """
+        Compiled permissions, cached by the permission list
+        :param perms: list of permissions
+        :return: trie
+        """
+        key = tuple(perms)
+        try:
+            return self._compiled[key]
+        except KeyError:
+            pass
 
-            if perm[0] == "*":
-                merged["*"] = True
-            else:
-                merged[perm[0]].append(perm[1:])
+        if len(self._compiled) >= self.CACHE_SIZE:
+            self._compiled.clear()
+        compiled = self._compiled[key] = self.perms_merger([perm.split(".") for perm in key])
+        return compiled
 
-        for k in merged.keys():
-            if merged[k] is not True:
-                merged[k] = self.perms_merger(merged[k])
+    def split(self, req):
+        try:
+            return self._reqs[req]
+        except KeyError:
+            if len(self._reqs) >= self.CACHE_SIZE:
+                self._reqs.clear()
+            parts = self._reqs[req] = tuple(req.split("."))
+            return parts
 
-        return merged
+    @staticmethod
+    def granted(compiled, req):
+        """
+        Walk compiled permissions
+        :param req: required permission parts
+        :return: bool
+        """
+        node = compiled
+        for part in req:
+            if node is True:
+                return True
+            node = node.get(part)
+            if node is None:
+                return False
+        return node is True
 
     def has_permission(self, perms, reqs):
         """
@@ -39,20 +96,59 @@ class Permissions(KernelModule):
         :return: bool
         :raise: PermissionsException
         """
-        perms_splitter = lambda x: [i.split(".") for i in x]
-        perms = self.perms_merger(perms_splitter(perms))
-        reqs = perms_splitter(reqs)
-
-        getter = lambda src, x: src.get("*", src.get(x, False))
-        for reqsi in reqs:
-            src = perms
-            for r in reqsi:
-                g = getter(src, r)
-                if isinstance(g, dict):
-                    src = g
-                elif g:
-                    return True
-                else:
-                    raise PermissionsException(str(".".join(reqsi)))
-        else:
-            return True
\ No newline at end of file
+        compiled = self.compile(perms)
+        for req in reqs:
+            if not self.granted(compiled, self.split(req)):
+                raise PermissionsException(req)
+        return True
+
+    def principal(self, service):
+        """
+        Compiled permissions, protection flag and permissions of the service
+        Services are loaded at once, so routing doesn't wait for the registry after the first load
+        :return: (trie, bool, tuple)
+        """
+        try:
+            return self._principals[service]
+        except KeyError:
+            pass
+
+        if not self._loaded:
+            self.load(self.kernel.service.list())
+        return self._principals.get(service, self.NOBODY)
+
+    def _principal(self, service_info):
+        perms = tuple(service_info.get("permissions") or ())
+        return self.compile(perms), bool(service_info.get("protected")), perms
+
+    def load(self, services):
+        """
+        Compile permissions of all services
+        :param services: kernel/services data
+        """
+        self._principals = {service: self._principal(service_info) for service, service_info in services.items()}
+        self._loaded = True
+
+    def update(self, service, service_info):
+        """
+        Replace cached permissions after the service is saved to kernel/services
+        """
+        self._principals[service] = self._principal(service_info)
+
+    def authorize(self, caller, service, method, perms=None):
+        """
+        Check caller may request method of a protected service, requires "service.<service>.<method>"
+        Protection is only known on the service's node, so callers from other nodes present their permissions
+        :param perms: permissions of a caller from another node
+        :raise: PermissionsException
+        """
+        if not self.principal(service)[1]:
+            return
+        req = self._routes.get((service, method))
+        if req is None:
+            if len(self._routes) >= self.CACHE_SIZE:
+                self._routes.clear()
+            req = self._routes[service, method] = ("service", service) + tuple(method.split("."))
+        compiled = self.principal(caller)[0] if perms is None else self.compile(perms)
+        if not self.granted(compiled, req):
+            raise PermissionsException(".".join(req))
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+__author__ = "Alexey Kachalov"
+
+import cProfile
+import collections
+import io
+import logging
+import os
+import pstats
+import random
+import time
+
+from craftengine.modules import KernelModule
+
+
+class Trace(object):
+    """
+    Per-stage timings of one request passing the router
+    """
+
+    __slots__ = ("context", "queued", "stages", "started", "last")
+
+    def __init__(self):
+        self.context = None
+        self.queued = False
+        self.stages = []
+        self.started = self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    @property
+    def total(self):
+        return self.last - self.started
+
+    def dump(self):
+        return {
+            "context": self.context,
+            "stages": self.stages,
+            "total": self.total,
+        }
+
+    def __str__(self):
+        return ", ".join("%s %.6fs" % stage for stage in self.stages)
+
+
+class Profiler(KernelModule):
+    sample = 0.0
+    threshold = None
+    traces = None
+    attached = None
+
+    _profile = None
+    _profile_seconds = None
+    _profile_until = None
+
+    def init(self, *args, **kwargs):
+        self.sample = float(self.kernel.env.get("CE_PROFILE_SAMPLE", 0))
+        threshold = self.kernel.env.get("CE_SLOW_REQUEST")
+        self.threshold = None if threshold is None else float(threshold)
+        self.traces = collections.deque(maxlen=100)
+        self.attached = {}
+
+    def trace(self):
+        """
+        Start trace for a sampled share of requests
+        :return: Trace or None
+        """
+        if self.sample and random.random() < self.sample:
+            return Trace()
+        return None
+
+    def attach(self, frame, trace):
+        """
+        Keep tracing the frame while it waits in the send queue
+        The frame is kept along with its trace, so its id isn't reused by another frame
+        """
+        trace.queued = True
+        self.attached[id(frame)] = frame, trace
+
+    def detach(self, frame):
+        attached = self.attached.get(id(frame))
+        if attached is None or attached[0] is not frame:
+            return None
+        del self.attached[id(frame)]
+        return attached[1]
+
+    def drop(self, frames):
+        """
+        Stop tracing frames that won't be sent
+        """
+        if self.attached:
+            for frame in frames:
+                self.detach(frame)
+
+    def finish(self, trace):
+        self.traces.append(trace)
+
+    def slow(self, context, duration, trace=None):
+        if self.threshold is None or duration < self.threshold:
+            return
+        if trace is None:
+            logging.warning("Slow request %s: %.6fs" % (context, duration))
+        else:
+            logging.warning("Slow request %s: %.6fs (%s)" % (context, duration, trace))
+
+    def configure(self, sample=None, threshold=None, dump=None):
+        """
+        Change profiling at runtime
+        :param sample: share of traced requests (0 disables tracing)
+        :param threshold: slow request threshold in seconds (False disables log)
+        :param dump: profile RPC thread for given number of seconds
+        :return: current settings and recent traces
+        """
+        if sample is not None:
+            self.sample = min(max(float(sample), 0.0), 1.0)
+            if not self.sample:
+                self.attached.clear()
+        if threshold is not None:
+            self.threshold = None if threshold is False else float(threshold)
+        if dump is not None:
+            self._profile_seconds = float(dump)
+
+        return {
+            "sample": self.sample,
+            "threshold": self.threshold,
+            "profiling": self._profile is not None or self._profile_seconds is not None,
+            "traces": [trace.dump() for trace in self.traces],
+        }
+
+    def tick(self):
+        """
+        Start or finish requested profile, called from the profiled thread
+        """
+        if self._profile_seconds is not None:
+            if self._profile is None:
+                self._profile = cProfile.Profile()
+                self._profile_until = time.monotonic() + self._profile_seconds
+                self._profile.enable()
+                logging.info("Profiling for %.1fs" % self._profile_seconds)
+            self._profile_seconds = None
+        elif self._profile is not None and time.monotonic() >= self._profile_until:
+            self._profile.disable()
+            self._dump(self._profile)
+            self._profile = None
+
+    def _dump(self, profile):
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(30)
+        logging.info("Profile:\n%s" % stream.getvalue())
+
+        path = self.kernel.env.get("CE_PROFILE_DIR")
+        if path is not None:
+            path = os.path.join(path, "kernel-rpc-%i.prof" % time.time())
+            profile.dump_stats(path)
+            logging.info("Profile saved: %s" % path)
@@ -7,7 +7,6 @@ import random
 import json
 import logging
 
-import lupa
 from craftengine.exceptions import ModuleException
 from craftengine.modules import KernelModule
 
@@ -330,6 +329,7 @@ class _Registry(KernelModule):
         elif h is False:
             raise AccessException
         elif isinstance(h, str):
+            import lupa
             lua = lupa.LuaRuntime(unpack_returned_tuples=True)
             result = lua.eval(h)(*data)
             if not result:
@@ -355,26 +355,34 @@ class _Registry(KernelModule):
         self.data_handler(kwargs["data_type"]).create(meta["data_id"])
         return self.meta_set(key, {"lock": "rw"})
 
-    def get(self, key, **kwargs):
+    def get(self, key, trusted=None, **kwargs):
+        """
+        Get data
+        :param key: key
+        :param trusted: kernel's own call, access handler is skipped
+        """
         meta = self.meta_get(key)
         if meta is None:
             raise KeyError
 
-        self.handler(meta["handler"], meta["handler_lua"], "get", key, kwargs)
+        if not trusted:
+            self.handler(meta["handler"], meta["handler_lua"], "get", key, kwargs)
 
         if meta["lock"] in [self.valid_lock_type(x) for x in ["rw", "ro"]]:
             return self.data_handler(meta["type"]).get(key, meta["data_id"], **kwargs)
         else:
             raise LockException
 
-    def set(self, key, **kwargs):
+    def set(self, key, trusted=None, **kwargs):
         with _DataLock(self, key) as meta:
-            self.handler(meta["handler"], meta["handler_lua"], "set", key, kwargs)
+            if not trusted:
+                self.handler(meta["handler"], meta["handler_lua"], "set", key, kwargs)
             return self.data_handler(meta["type"]).set(key, meta["data_id"], **kwargs)
 
-    def rem(self, key, **kwargs):
+    def rem(self, key, trusted=None, **kwargs):
         with _DataLock(self, key, mode="na") as meta:
-            self.handler(meta["handler"], meta["handler_lua"], "rem", key, kwargs)
+            if not trusted:
+                self.handler(meta["handler"], meta["handler_lua"], "rem", key, kwargs)
             return self.data_handler(meta["type"]).rem(key, meta["data_id"], **kwargs)
 
 
@@ -1,30 +1,58 @@
 # -*- coding: utf-8 -*-
 __author__ = "Alexey Kachalov"
 
+import os
+import array
+import heapq
+import binascii
+import collections
 import socket
 import select
 import logging
 import threading
 import traceback
+import itertools
+import json
+import struct
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from ddp import DdpSocket
 from craftengine.exceptions import ModuleException
+from craftengine.limits import RateLimitException
 from craftengine.modules import KernelModule
+from craftengine.stats import ConnectionStats, MeteredSocket
 
 # Service
-# ["connect", "service", "instance", "token", {"params": True}] <-
-# ["connect", "status"] ->
+# ["connect", "service", "instance", "token", {"session": "session", "resume": True, "batch": True, "priority": "normal",
+#     "methods": {"method": {"idempotent": True, "retries": 1, "hedge": True,
+#         "coalesce": True, "cache_ttl": 1.0, "cache_size": 128}}}] <-
+# ["connect", "status", "session"] ->
 # ["request", ["node", "service", "instance"], "method", ("args"), {"kwargs": True}, "rid"] <-
+# ["request", ["node", "service", "instance"], "method", ("args"), {"kwargs": True}, "rid", "priority"] <-
 # ["request", ["req_from_n", "req_from_s", "req_from_i"], "method", ("args"), {"kwargs": True}, "rid"] ->
 # ["response", "data", "error", "rid"] <->
+# ["response_chunk", "data", "end", "rid"] <-> (streamed response, ends with "end" set or with "response")
+# ["credit", "rid", "chunks"] <-> (caller allows more chunks of the stream)
+# The kernel doesn't inspect "args" and "kwargs", though DDP decodes and encodes them again on the way;
+# a service may pass a pre-encoded payload as binary "args" with "kwargs" set to None to keep that cheap.
+# ["request", ["node", "__kernel__", None], "method", ["event", "data"], None, None] -> (event callback)
+# ["request", ["node", "__kernel__", None], "method", ("args"), {"kwargs": True}, "rid"] <- (kernel method)
+# ["batch", [["request", ...], ["response", ...], ...]] <->
+# "batch" frames are sent only to services that connected with "batch" param
+# ["stats", "rid"] <-
+# ["profile", {"sample": 0.01, "threshold": 0.5, "dump": 10}, "rid"] <-
 
 
 # Node
-# ["connect_node", "node_name", "token", {"params": True}] <-
+# ["connect_node", "node_name", "token", {"batch": True}] <-
 # ["connect_node" "status"] ->
 # ["proxy", "node_name", ["req_from_n", "req_from_s", "req_from_i"], "command", "rid"] <->
+# ["proxy", "node_name", ["req_from_n", "req_from_s", "req_from_i"], ["request", ...], "rid", ["permission", ...]] <->
+# (caller's permissions, checked by the service's node)
 # ["proxy_status", "error", "rid"] <-
+# ["batch", [["proxy", ...], ...]] <->
+# ["events", [["eid", "name", "data", ["visited_node", ...]], ...]] <->
 
 
 class RpcException(ModuleException):
@@ -43,7 +71,27 @@ class NodeException(RpcException):
     pass
 
 
+class DrainException(RpcException):
+    pass
+
+
+def error_data(e):
+    return [
+        "%s.%s" % (
+            getattr(e, "__module__", "__built_in__"),
+            e.__class__.__name__,
+        ),
+        str(e),
+        "".join(traceback.format_exception(type(e), e, e.__traceback__)),
+    ]
+
+
 class BaseHandler(object):
+    PROCESS_BATCH = "batch"
+
+    # Route cases written in one batch frame to connections that accept batches
+    BATCHED = ()
+
     def __init__(self, router):
         self.rpc = router.rpc
         self.kernel = router.rpc.kernel
@@ -51,34 +99,85 @@ class BaseHandler(object):
         self.binds = {}
 
     def socket_receive(self, fn):
-        sock = self.router.get_socket(fn)["socket"]
+        """
+        Read frames while the connection has data, up to the read budget of its priority class
+        """
+        sock_info = self.router.get_socket(fn)
+        budget = self.router.READ_BUDGET[sock_info["priority"]]
+        while True:
+            self.receive_frame(fn, sock_info)
+            budget -= 1
+            if budget <= 0 or not self.router.is_socket(fn, sock_info):
+                return
+            # Connection has been authed or paused by the frame
+            if self.router.get_handler(sock_info["type"]) is not self or sock_info["type"] == self.router.SOCK_REG:
+                return
+            if not sock_info["socket"].readable():
+                return
+
+    def receive_frame(self, fn, sock_info):
+        trace = self.router.trace = self.kernel.profiler.trace()
         try:
-            data = DdpSocket().decode(sock)
+            data = DdpSocket().decode(sock_info["socket"])
         except IndexError as e:
             logging.debug(e)
             self.socket_close(fn)
             raise RouteException("Problems with connection")
 
-        self.process(fn, data)
+        sock_info["stats"].frames_in += 1
+        self.router.priority = sock_info["priority"]
+        if trace is None:
+            try:
+                self.process(fn, data)
+            finally:
+                self.router.priority = self.router.PRIORITY_NORMAL
+            return
+
+        trace.mark("decode")
+        try:
+            self.process(fn, data)
+        finally:
+            self.router.trace = None
+            self.router.priority = self.router.PRIORITY_NORMAL
+            if not trace.queued:
+                self.kernel.profiler.finish(trace)
 
     def socket_send(self, fn):
         sock_info = self.router.get_socket(fn)
-        sock, send_data = sock_info["socket"], sock_info["send_data"]
-        while len(send_data) > 0:
-            data = send_data.pop(0)
-            try:
+        sock, send_data, stats = sock_info["socket"], sock_info["send_data"], sock_info["stats"]
+        profiler = self.kernel.profiler
+        sock.cork()
+        try:
+            while len(send_data) > 0:
+                frames = [send_data.popleft()]
+                if sock_info["batch"] and frames[0][0] in self.BATCHED:
+                    while len(send_data) > 0 and send_data.peek()[0] in self.BATCHED:
+                        frames.append(send_data.popleft())
+                data = frames[0] if len(frames) == 1 else [self.PROCESS_BATCH, frames]
+
+                traces = [profiler.detach(frame) for frame in frames] if profiler.attached else []
+                traces = [trace for trace in traces if trace is not None]
+                for trace in traces:
+                    trace.mark("flush")
                 DdpSocket().encode(data, socket=sock)
-            except IndexError as e:
-                logging.debug(e)
-                self.socket_close(fn)
-                raise RouteException("Problems with connection")
+                stats.frames_out += 1
+                for trace in traces:
+                    trace.mark("encode")
+                    profiler.finish(trace)
+            sock.uncork()
+        except IndexError as e:
+            logging.debug(e)
+            self.socket_close(fn)
+            raise RouteException("Problems with connection")
         self.router.epollin(fn)
 
     def socket_close(self, fn):
-        sock = self.router.get_socket(fn)["socket"]
+        sock_info = self.router.get_socket(fn)
         self.rpc.epoll.unregister(fn)
         self.router.del_socket(fn)
-        sock.close()
+        sock_info["socket"].close()
+        # Frames kept for a parked session are sent untraced
+        self.kernel.profiler.drop(sock_info["send_data"])
 
     def process(self, fn, data, add=None):
         case = data.pop(0)
@@ -87,6 +186,21 @@ class BaseHandler(object):
         else:
             raise RouteException("Unexpected route case: %s" % case)
 
+    def process_batch(self, fn, data, add=None):
+        """
+        Process frames of a batch one by one, their results are grouped again by destination when written
+        """
+        frames, = data
+        sock_info = self.router.get_socket(fn)
+        for frame in frames:
+            if frame[0] not in self.BATCHED:
+                raise RouteException("Unexpected route case in batch: %s" % frame[0])
+            self.router.priority = sock_info["priority"]
+            self.process(fn, frame, add)
+            # Connection is closed on failed fire-and-forget request
+            if not self.router.is_socket(fn, sock_info):
+                return
+
 
 class RegularHandler(BaseHandler):
     PROCESS_SERVICE = "connect"
@@ -106,167 +220,901 @@ class RegularHandler(BaseHandler):
 
     def process_service(self, fn, data, _=None):
         service, instance, token, params = data
-        service_data = self.kernel.service.list().get(service)
-        if service_data is None:
-            raise RouteException("Service doesn't exist")
+        # Nothing more is read from the connection until it is authed
+        self.router.pause(fn)
+        self.rpc.submit(self._load_service, (service,), self._auth_service, fn, self.router.get_socket(fn), data)
+
+    def _load_service(self, service):
+        services = self.kernel.service.list()
+        self.kernel.permissions.load(services)
+        self.kernel.limits.load(services)
+        return services.get(service)
+
+    def _auth_service(self, service_data, e, fn, sock_info, data):
+        if not self.router.is_socket(fn, sock_info):
+            return
+        service, instance, token, params = data
+        try:
+            if e is not None:
+                raise e
+            if service_data is None:
+                raise RouteException("Service doesn't exist")
 
-        if token != service_data["token"]:
-            raise RouteException("Invalid token")
+            if token != service_data["token"]:
+                raise RouteException("Invalid token")
 
-        if not 1 <= instance <= service_data.get("scale", 1):
-            raise RouteException("Unexpected instance")
+            if not 1 <= instance <= service_data.get("scale", 1):
+                raise RouteException("Unexpected instance")
+        except Exception as e:
+            logging.exception(e)
+            self.socket_close(fn)
+            return
 
         services_handler = self.router.get_handler(self.router.SOCK_SERVICE)
-        services_handler.put_service(service, instance, fn)
+        session = services_handler.put_service(service, instance, fn, params)
+        # Service may connect with a lower priority than the one it is given
+        sock_info["priority"] = max(
+            self.router.priority_class(service_data.get("priority")),
+            self.router.priority_class((params or {}).get("priority")),
+        )
+        sock_info["send_data"].append([self.PROCESS_SERVICE, True, session])
+        self.router.epollout(fn)
         logging.info("Service authed: `%s`[%i]" % (service, instance))
 
     def process_node(self, fn, data, _=None):
         node, token, params = data
-        node_data = self.kernel.g.get("kernel/nodes", keys=[node]).get(node)
-        if node_data is None:
-            raise RouteException("Node doesn't exist")
+        self.router.pause(fn)
+        self.rpc.submit(self._load_node, (node,), self._auth_node, fn, self.router.get_socket(fn), data)
+
+    def _load_node(self, node):
+        return self.kernel.g.get("kernel/nodes", keys=[node]).get(node)
+
+    def _auth_node(self, node_data, e, fn, sock_info, data):
+        if not self.router.is_socket(fn, sock_info):
+            return
+        node, token, params = data
+        try:
+            if e is not None:
+                raise e
+            if node_data is None:
+                raise RouteException("Node doesn't exist")
 
-        if token != node_data["token"]:
-            raise RouteException("Invalid token")
+            if token != node_data["token"]:
+                raise RouteException("Invalid token")
+        except Exception as e:
+            logging.exception(e)
+            self.socket_close(fn)
+            return
 
         node_handler = self.router.get_handler(self.router.SOCK_NODE)
         node_handler.put_node(node, fn)
+        sock_info["batch"] = bool((params or {}).get("batch"))
+        self.router.epollin(fn)
         logging.info("Node authed: `%s`" % node)
 
 
 class ServiceHandler(BaseHandler):
     BALANCED_INSTANCE = 0
 
+    # Latency samples of a route required to hedge after its p95
+    HEDGE_SAMPLES = 20
+    # Responses cached for a method by default
+    CACHE_SIZE = 128
+
+    # Reserved service answered by the kernel itself
+    KERNEL = "__kernel__"
+
     PROCESS_REQUEST = "request"
     PROCESS_RESPONSE = "response"
+    PROCESS_RESPONSE_CHUNK = "response_chunk"
+    PROCESS_CREDIT = "credit"
+    PROCESS_STATS = "stats"
+    PROCESS_PROFILE = "profile"
+
+    BATCHED = (PROCESS_REQUEST, PROCESS_RESPONSE, PROCESS_RESPONSE_CHUNK, PROCESS_CREDIT)
 
     def __init__(self, router):
         super().__init__(router)
         self.binds = {
             self.PROCESS_REQUEST: self.process_request,
             self.PROCESS_RESPONSE: self.process_response,
+            self.PROCESS_RESPONSE_CHUNK: self.process_response_chunk,
+            self.PROCESS_CREDIT: self.process_credit,
+            self.PROCESS_BATCH: self.process_batch,
+            self.PROCESS_STATS: self.process_stats,
+            self.PROCESS_PROFILE: self.process_profile,
         }
         self._services = {}
         self._services_fn = {}
         self._balancing_instances = {}
         self._lock = threading.RLock()
+        self._connected = threading.Condition()
+        # session id -> {"id", "service", "instance", "fn", "parked", "timer"}
+        self._sessions = {}
+        self._instances_sessions = {}
+        self.session_timeout = float(self.kernel.env.get("CE_SESSION_TIMEOUT", 30))
+        # service -> {method: {"idempotent", "retries", "hedge", "coalesce", "cache_ttl", "cache_size"}},
+        # declared by the service at connect
+        self._policies = {}
+        # (service, method, arguments) -> group of the request callers wait for
+        self._coalescing = {}
+        # (service, method) -> {(service, method, arguments): (expires, response, responder)}, LRU ordered
+        self._caches = {}
+        # (caller's connection, caller's request id) -> {"fn", "node", "iid", "credit"}
+        self._streams = {}
+        self.stream_window = int(self.kernel.env.get("CE_STREAM_WINDOW", 16))
+        # Permissions of the caller of the proxied frame being processed
+        self.remote_perms = None
+        # Pending calls of kernel methods, kept like the ones of a connection
+        self._kernel_calls = {"responses": {}, "ids": itertools.count(1)}
 
     def socket_close(self, fn):
         service, instance = self.get_service_by_socket(fn)
         logging.info("Closed connection with service `%s`[%i]" % (service, instance))
+        sock_info = self.router.get_socket(fn)
+        self._unbind_service(service, instance, fn)
         super().socket_close(fn)
+        self._park(service, instance, fn, sock_info)
 
-    def request(self, fn, req_from, req, method, args, kwargs, rid):
-        node, service, instance = req
-        requested_fn = self.get_service(service, instance)
-        requested_sock_info = self.router.get_socket(requested_fn)
+    def _unbind_service(self, service, instance, fn):
+        with self._connected:
+            del self._services_fn[fn]
+        instances = self._services.get(service, {})
+        if instances.get(instance) == fn:
+            del instances[instance]
+            if len(instances) == 0:
+                del self._services[service]
+
+    def _park(self, service, instance, fn, sock_info):
+        """
+        Keep queued and pending data of a closed connection until the instance resumes its session
+        """
+        session_id = self._instances_sessions.get((service, instance))
+        session = self._sessions.get(session_id)
+        if session is None or session["fn"] != fn:
+            self.fail_pending(sock_info)
+            self.rebind_callers(fn, None)
+            return
+
+        # Idempotent and hedged requests are retried or left to their other attempts instead of waiting for the instance
+        responses = sock_info["responses"]
+        for iid, pending in list(responses.items()):
+            group = pending[6]
+            if group is not None and (group["idempotent"] or group["pending"] > 1):
+                self.fail_response(responses.pop(iid), ServiceException("Service instance disconnected"), responses)
+
+        session["fn"] = None
+        session["parked"] = sock_info
+        session["timer"] = self.rpc.call_later(self.session_timeout, self._expire, session_id)
+        self.rebind_callers(fn, session_id)
+
+    def _expire(self, session_id):
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return
+
+        key = session["service"], session["instance"]
+        if self._instances_sessions.get(key) == session_id:
+            del self._instances_sessions[key]
+        if session["timer"] is not None:
+            self.rpc.cancel(session["timer"])
+        if session["parked"] is not None:
+            logging.info("Session of service `%s`[%i] expired" % key)
+            self.fail_pending(session["parked"])
+            self.rebind_callers(session_id, None)
+
+    def _resume(self, session, fn, resume):
+        """
+        Move queued and pending data of the previous connection of the session
+        :param resume: same process reconnects, so requests it has already received will be answered
+        """
+        sock_info = self.router.get_socket(fn)
+        if session["parked"] is not None:
+            old_sock_info, old = session["parked"], session["id"]
+            self.rpc.cancel(session["timer"])
+            session["parked"] = session["timer"] = None
+        else:
+            old = session["fn"]
+            old_sock_info = self.router.get_socket(old)
+            self._unbind_service(session["service"], session["instance"], old)
+            BaseHandler.socket_close(self, old)
+
+        send_data, responses = old_sock_info["send_data"], old_sock_info["responses"]
+        if not resume:
+            queued = set(frame[-1] for frame in send_data if frame[0] == self.PROCESS_REQUEST)
+            for iid in list(responses.keys()):
+                if iid not in queued:
+                    self.fail_response(responses.pop(iid), ServiceException("Service instance restarted"), responses)
+
+        send_data.merge(sock_info["send_data"])
+        sock_info["send_data"] = send_data
+        sock_info["responses"] = responses
+        sock_info["ids"] = old_sock_info["ids"]
+        self.rebind_callers(old, fn)
+
+    def idle(self):
+        return len(self._kernel_calls["responses"]) == 0
+
+    def abandon(self, e):
+        """
+        Fail all pending requests, before connections are handed over to another kernel
+        """
+        for _, sock_info in self.router.sockets():
+            self.fail_pending(sock_info, e)
+        self.fail_pending(self._kernel_calls, e)
+        for session_id in [s["id"] for s in self._sessions.values() if s["parked"] is not None]:
+            self._expire(session_id)
+
+    def export(self):
+        """
+        Sessions of connected instances and method policies, for the kernel taking connections over
+        """
+        return {
+            "sessions": [
+                {k: session[k] for k in ["id", "service", "instance", "fn"]}
+                for session in self._sessions.values()
+                if session["fn"] is not None
+            ],
+            "policies": self._policies,
+        }
+
+    def adopt(self, state, fns):
+        """
+        :param state: exported by the previous kernel
+        :param fns: connections of the previous kernel -> adopted ones
+        """
+        self._policies = state["policies"]
+        for session in state["sessions"]:
+            fn = fns.get(session["fn"])
+            if fn is None:
+                continue
+            service, instance = session["service"], session["instance"]
+            self._sessions[session["id"]] = dict(session, fn=fn, parked=None, timer=None)
+            self._instances_sessions[service, instance] = session["id"]
+            self._services.setdefault(service, {})[instance] = fn
+            with self._connected:
+                self._services_fn[fn] = (service, instance)
+
+    def get_session(self, service, instance):
+        return self._instances_sessions.get((service, instance))
+
+    def rebind_callers(self, old, new):
+        """
+        Point pending responses of the caller to another connection or parked session
+        """
+        parked = [s["parked"] for s in self._sessions.values() if s["parked"] is not None]
+        for sock_info in [i for _, i in self.router.sockets()] + parked + [self._kernel_calls]:
+            responses = sock_info["responses"]
+            for iid, pending in list(responses.items()):
+                if pending[0] == old:
+                    responses[iid] = (new,) + pending[1:]
+                    if pending[6] is not None:
+                        pending[6]["fn"] = new
+        for key in [key for key in self._streams.keys() if key[0] == old]:
+            self._streams[new, key[1]] = self._streams.pop(key)
+        for group in self._coalescing.values():
+            group["waiters"] = [(new if w[0] == old else w[0],) + w[1:] for w in group["waiters"]]
+
+    def fail_response(self, pending, e, responses=None):
+        """
+        :param responses: pending responses of the connection the request was sent to
+        """
+        fn, req_from, rid, route, started, trace, group = pending
+        route.in_flight -= 1
+        if group is not None:
+            group["pending"] -= 1
+            if group["winner"] is not None and group["winner"] is not responses:
+                return
+            if group["winner"] is None:
+                # Another attempt is still running
+                if group["pending"] > 0:
+                    return
+                if group["idempotent"] and group["retries"] > 0 and self.retry(group):
+                    return
+            self.win(group, responses)
+            for waiter_fn, waiter_from, waiter_rid in self.release(group):
+                self.respond(waiter_fn, waiter_from, None, error_data(e), waiter_rid)
+        route.errors += 1
+        self._streams.pop((fn, rid), None)
+        self.respond(fn, req_from, None, error_data(e), rid)
+
+    def fail_pending(self, sock_info, e=None):
+        e = ServiceException("Service instance disconnected") if e is None else e
+        responses = sock_info["responses"]
+        while len(responses) > 0:
+            self.fail_response(responses.popitem()[1], e, responses)
+
+    def request(self, fn, req_from, frame, route):
+        """
+        Forward request to the requested instance
+        :param fn: caller's connection
+        :param req_from: caller's address
+        :param frame: received frame without case, reused as the outgoing one
+        :param route: route stats of the request
+        """
+        node, service, instance = frame[0]
+        policy = key = None
+        if frame[4] is not None and instance == self.BALANCED_INSTANCE:
+            policy = self._policies.get(service, {}).get(frame[1])
+        if policy is not None and (policy.get("coalesce") or policy.get("cache_ttl")):
+            key = self.coalesce_key(frame)
+            # Answered without reaching the service, so not counted against its limits
+            if key is not None and self.coalesce(key, fn, req_from, frame[4], route, policy):
+                return
+
+        # Rejected before queueing, so an overloaded service is not flooded further
+        self.kernel.limits.admit(req_from[1], service)
+        try:
+            requested_fn = self.get_service(service, instance)
+            requested_sock_info = self.router.get_socket(requested_fn)
+        except RouteException:
+            # Instance is reconnecting: queue until it resumes the session
+            requested_fn = None
+            requested_sock_info = self.get_parked(service, instance)
+        trace = self.router.trace
+        if trace is not None:
+            trace.mark("route")
+            trace.context = route.name
+
+        group = None
+        if policy is not None:
+            group = self.group(fn, req_from, frame, route, policy)
+            group["tried"].add(requested_fn)
+            if key is not None and policy.get("coalesce"):
+                group["key"] = key
+                self._coalescing[key] = group
+            elif key is not None:
+                group["cache"] = key
+        if frame[4] is not None:
+            frame[4] = self.router.bind_response(requested_sock_info, fn, req_from, frame[4], route, group)
+
+        frame[0] = req_from
+        frame.insert(0, self.PROCESS_REQUEST)
+        requested_sock_info["send_data"].append(frame)
+        if trace is not None:
+            self.kernel.profiler.attach(frame, trace)
+
+        if requested_fn is not None:
+            self.router.epollout(requested_fn)
+
+    def group(self, fn, req_from, frame, route, policy):
+        """
+        Attempts of a request to a method with hedging or retry policy
+        First response wins, responses of other attempts are dropped
+        """
+        (_, service, _), method, args, kwargs, rid = frame
+        group = {
+            "service": service,
+            "method": method,
+            "args": args,
+            "kwargs": kwargs,
+            "fn": fn,
+            "req_from": req_from,
+            "rid": rid,
+            "route": route,
+            "idempotent": bool(policy.get("idempotent")),
+            "retries": int(policy.get("retries", 1)) if policy.get("idempotent") else 0,
+            "pending": 1,
+            # Pending responses of the connection that answered first
+            "winner": None,
+            "tried": set(),
+            "timer": None,
+            "policy": policy,
+            # Coalescing key, callers waiting for the response as (fn, caller's address, rid)
+            "key": None,
+            "waiters": [],
+            # Cache key of a request that isn't coalesced
+            "cache": None,
+        }
 
+        hedge = policy.get("hedge")
+        if hedge is True:
+            # Hedge after p95 latency, once there are enough samples
+            hedge = route.latency.quantile(0.95) if route.latency.count >= self.HEDGE_SAMPLES else None
+        if hedge is not None and hedge is not False and hedge != float("inf"):
+            group["timer"] = self.rpc.call_later(float(hedge), self.hedge, group)
+        return group
+
+    @staticmethod
+    def win(group, responses):
+        """
+        Check response of the connection is the first one or continues the first one
+        """
+        if group["winner"] is None:
+            group["winner"] = responses
+            if group["timer"] is not None:
+                Rpc.cancel(group["timer"])
+        return group["winner"] is responses
+
+    def attempt(self, group):
+        """
+        Send another attempt of the request to an instance that hasn't got it yet
+        :return: bool
+        """
+        try:
+            instances = self.get_service(group["service"])
+        except RouteException:
+            return False
+        with self._lock:
+            candidates = [i for i in instances.values() if i not in group["tried"]]
+            if len(candidates) == 0:
+                return False
+            # Attempts share the balancing counter, so they don't all land on the first instance
+            counter = self._balancing_instances.get(group["service"], -1) + 1
+            self._balancing_instances[group["service"]] = counter % len(instances)
+            requested_fn = candidates[counter % len(candidates)]
+
+        requested_sock_info = self.router.get_socket(requested_fn)
+        iid = self.router.bind_response(
+            requested_sock_info, group["fn"], group["req_from"], group["rid"], group["route"], group,
+        )
         requested_sock_info["send_data"].append([
             self.PROCESS_REQUEST,
-            req_from,
-            method,
-            args,
-            kwargs,
-            rid,
+            group["req_from"],
+            group["method"],
+            group["args"],
+            group["kwargs"],
+            iid,
         ])
+        self.router.epollout(requested_fn)
+        group["tried"].add(requested_fn)
+        group["pending"] += 1
+        return True
+
+    def hedge(self, group):
+        group["timer"] = None
+        if group["winner"] is None and group["pending"] > 0 and self.attempt(group):
+            group["route"].hedged += 1
+
+    def retry(self, group):
+        group["retries"] -= 1
+        if self.attempt(group):
+            group["route"].retried += 1
+            return True
+        return False
+
+    @staticmethod
+    def coalesce_key(frame):
+        """
+        :return: key of identical requests or None for arguments that can't be compared
+        """
+        (_, service, _), method, args, kwargs, _ = frame
+        try:
+            return service, method, json.dumps([args, kwargs], sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+
+    def coalesce(self, key, fn, req_from, rid, route, policy):
+        """
+        Answer request from the cache or join identical request in flight
+        :return: bool, request doesn't have to be sent
+        """
+        cache = self._caches.get(key[:2])
+        if cache is not None:
+            entry = cache.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                cache.move_to_end(key)
+                route.coalesced += 1
+                self.respond(fn, req_from, entry[1], None, rid, entry[2])
+                return True
+            elif entry is not None:
+                del cache[key]
+
+        group = self._coalescing.get(key) if policy.get("coalesce") else None
+        if group is None:
+            return False
+        route.coalesced += 1
+        group["waiters"].append((fn, req_from, rid))
+        return True
+
+    def release(self, group):
+        """
+        Stop coalescing identical requests into the group, its response has come
+        :return: waiting callers
+        """
+        key = group["key"]
+        if key is not None and self._coalescing.get(key) is group:
+            del self._coalescing[key]
+        return group["waiters"]
+
+    def cache(self, group, response, resp_from):
+        key = group["key"] or group["cache"]
+        ttl = group["policy"].get("cache_ttl")
+        if key is None or not ttl:
+            return
+        cache = self._caches.setdefault(key[:2], collections.OrderedDict())
+        cache[key] = (time.monotonic() + float(ttl), response, resp_from)
+        cache.move_to_end(key)
+        size = int(group["policy"].get("cache_size", self.CACHE_SIZE))
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+    def respond(self, fn, req_from, response, error, rid, resp_from=None):
+        """
+        Deliver response to the caller's connection
+        :param fn: caller's connection (service or node)
+        :param req_from: caller's address
+        :param rid: caller's request id
+        :param resp_from: responder's address
+        """
+        self.deliver(fn, req_from, [self.PROCESS_RESPONSE, response, error, rid], resp_from)
+
+    def deliver(self, fn, req_from, frame, resp_from=None):
+        """
+        Deliver frame of a response to the caller's connection
+        """
+        try:
+            sock_info = self.router.get_socket(fn)
+        except KeyError:
+            session = self._sessions.get(fn)
+            if session is None or session["parked"] is None:
+                logging.debug("Caller has gone, response dropped: %s" % frame[-1])
+            else:
+                session["parked"]["send_data"].append(frame)
+            return
 
-        if rid is not None:
-            requested_sock_info["responses"][rid] = (fn, req_from)
+        if sock_info["type"] == self.router.SOCK_SERVICE:
+            sock_info["send_data"].append(frame)
+            self.router.epollout(fn)
+        else:
+            resp_from = (self.router.name, None, None) if resp_from is None else resp_from
+            handler = self.router.get_handler(self.router.SOCK_NODE)
+            handler.process(fn, [
+                handler.PROCESS_PROXY,
+                req_from[0],
+                resp_from,
+                frame,
+                self.router.generate_id(),
+            ])
 
-        self.router.epollout(requested_fn)
+    def notify(self, service, instance, frames):
+        """
+        Queue fire-and-forget request frames to the instance with a single wake-up
+        :param instance: instance number or None for a balanced instance
+        :param frames: request frames without response id
+        """
+        instance = self.BALANCED_INSTANCE if instance is None else int(instance)
+        try:
+            requested_fn = self.get_service(service, instance)
+            requested_sock_info = self.router.get_socket(requested_fn)
+        except RouteException:
+            requested_fn = None
+            requested_sock_info = self.get_parked(service, instance)
+
+        requested_sock_info["send_data"].extend(frames)
+        if requested_fn is not None:
+            self.router.epollout(requested_fn)
 
     def process_request(self, fn, data, add=None):
         if add is None:
-            from_service = self.get_service_by_socket(fn)
-            req_from = self.router.name, from_service[0], from_service[1]
+            req_from = self.router.get_socket(fn)["principal"]
         else:
             req_from = add
 
         rid = None
+        route = None
         try:
-            (node, service, instance), method, args, kwargs, rid = data
-            logging.debug(data)
+            # Only the routing header is read, the decoded frame is reused as the outgoing one
+            if len(data) > 5:
+                # Request may only lower its priority
+                self.router.priority = max(self.router.priority, self.router.priority_class(data.pop()))
+            (node, service, instance), method, _, _, rid = data
+            logging.debug("Request: %s", data)
+            route = self.kernel.stats.route(service, method)
+            route.requests += 1
             instance = self.BALANCED_INSTANCE if instance is None else int(instance)
-            if node not in ["__local__", self.router.name]:
+            if self.rpc.draining:
+                raise DrainException("Kernel is restarting")
+            local = node in ["__local__", self.router.name]
+            if service == self.KERNEL:
+                # Kernel methods of proxied requests are authorized by the caller's node
+                if add is None:
+                    self.kernel.api.check(req_from[1], method)
+            elif local:
+                # Service's protection is only known on its node
+                self.kernel.permissions.authorize(req_from[1], service, method, None if add is None else self.remote_perms)
+            data[0] = node, service, instance
+            if not local:
                 handler = self.router.get_handler(self.router.SOCK_NODE)
                 node_fn = handler.get_node(node)
+                if rid is not None:
+                    data[4] = self.router.bind_response(self.router.get_socket(node_fn), fn, req_from, rid, route)
+
+                data.insert(0, self.PROCESS_REQUEST)
                 handler.process(node_fn, [
                     handler.PROCESS_PROXY,
                     node,
                     req_from,
-                    [self.PROCESS_REQUEST, (node, service, instance), method, args, kwargs, rid],
+                    data,
                     self.router.generate_id(),
+                    list(self.kernel.permissions.principal(req_from[1])[2]) if add is None else self.remote_perms,
                 ])
-
-                if rid is not None:
-                    sock_info = self.router.get_socket(node_fn)
-                    sock_info["responses"][rid] = (fn, req_from)
+            elif service == self.KERNEL:
+                self.kernel_request(fn, req_from, data, route)
             else:
-                req = node, service, instance
-
-                self.request(fn, req_from, req, method, args, kwargs, rid)
+                self.request(fn, req_from, data, route)
+        except (RateLimitException, DrainException) as e:
+            logging.debug(e)
+            route.rejected += 1
+            if rid is not None:
+                self.respond(fn, req_from, None, error_data(e), rid)
         except Exception as e:
             logging.exception(e)
+            if route is not None:
+                route.errors += 1
             if rid is None:
                 self.socket_close(fn)
             else:
-                error = [
-                    "%s.%s" % (
-                        getattr(e, "__module__", "__built_in__"),
-                        e.__class__.__name__,
-                    ),
-                    str(e),
-                    traceback.format_exc(),
-                ]
-
-                self.process(fn, [self.PROCESS_RESPONSE, None, error, rid])
-
-    def process_response(self, fn, data, _=None):
+                self.respond(fn, req_from, None, error_data(e), rid)
+
+    def kernel_request(self, fn, req_from, data, route):
+        """
+        Call kernel method, blocking methods run on the API worker pool
+        """
+        _, method, args, kwargs, rid = data
+        function, inline = self.kernel.api.get(method)
+        iid = None
+        if rid is not None:
+            iid = self.router.bind_response(self._kernel_calls, fn, req_from, rid, route)
+
+        if inline:
+            try:
+                result = function(req_from, *(args or ()), **(kwargs or {}))
+            except Exception as e:
+                self.kernel_response(iid, None, e)
+            else:
+                self.kernel_response(iid, result, None)
+        else:
+            self.kernel.api.submit(
+                function, req_from, args, kwargs,
+                lambda result, e: self.rpc.call_soon(self.kernel_response, iid, result, e),
+            )
+
+    def kernel_response(self, iid, result, e):
+        """
+        Send result of kernel method to the caller, called from the RPC thread
+        """
+        if e is not None:
+            logging.debug(e)
+        if iid is None:
+            return
+        try:
+            response_fn, req_from, rid, route, started, trace, _ = self._kernel_calls["responses"].pop(iid)
+        except KeyError:
+            return
+
+        duration = time.perf_counter() - started
+        route.in_flight -= 1
+        route.latency.observe(duration)
+        if e is not None:
+            route.errors += 1
+        if self.kernel.profiler.threshold is not None:
+            self.kernel.profiler.slow(route.name, duration, trace)
+
+        error = None if e is None else error_data(e)
+        self.respond(response_fn, req_from, result, error, rid, (self.router.name, self.KERNEL, None))
+
+    def process_response(self, fn, data, add=None):
         response, error, rid = data
-        sock_info = self.router.get_socket(fn)
-        response_fn, req_from = sock_info["responses"][rid]
-
-        response_sock_info = self.router.get_socket(response_fn)
-        if response_sock_info["type"] == self.router.SOCK_SERVICE:
-            response_sock_info["send_data"].append([
-                self.PROCESS_RESPONSE,
-                response,
-                error,
-                rid,
-            ])
-            self.router.epollout(response_fn)
+        if add is None:
+            sock_info = self.router.get_socket(fn)
+            resp_from = sock_info["principal"]
+        else:
+            # Proxied response: the pending entry lives on the current link to the responder's node
+            node_handler = self.router.get_handler(self.router.SOCK_NODE)
+            sock_info = self.router.get_socket(node_handler.get_node(add[0]))
+            resp_from = add
+
+        pending = self.complete(sock_info, rid, error)
+        if pending is None:
+            return
+        response_fn, req_from, rid, group = pending[0], pending[1], pending[2], pending[6]
+        self.respond(response_fn, req_from, response, error, rid, resp_from)
+        if group is not None:
+            if not error:
+                self.cache(group, response, resp_from)
+            for waiter_fn, waiter_from, waiter_rid in self.release(group):
+                self.respond(waiter_fn, waiter_from, response, error, waiter_rid, resp_from)
+
+    def complete(self, sock_info, iid, error):
+        """
+        Finish pending request on its last response frame
+        :param sock_info: connection the request was sent to
+        :return: pending request or None
+        """
+        responses = sock_info["responses"]
+        try:
+            pending = responses.pop(iid)
+        except KeyError:
+            logging.warning("Unexpected response id: %s" % iid)
+            return None
+        response_fn, req_from, rid, route, started, trace, group = pending
+        duration = time.perf_counter() - started
+        route.in_flight -= 1
+        if group is not None:
+            group["pending"] -= 1
+            if not self.win(group, responses):
+                logging.debug("Late response dropped: %s" % route.name)
+                return None
+        self._streams.pop((response_fn, rid), None)
+
+        route.latency.observe(duration)
+        if error:
+            route.errors += 1
+        if self.kernel.profiler.threshold is not None:
+            self.kernel.profiler.slow(route.name, duration, trace)
+        return pending
+
+    def process_response_chunk(self, fn, data, add=None):
+        """
+        Part of a streamed response, the request stays pending until the chunk with end marker
+        Responder may send stream_window chunks, and one more for each chunk credited by the caller
+        """
+        chunk, end, iid = data
+        if add is None:
+            sock_info = self.router.get_socket(fn)
+            resp_from, node = sock_info["principal"], None
+        else:
+            node_handler = self.router.get_handler(self.router.SOCK_NODE)
+            fn = node_handler.get_node(add[0])
+            sock_info = self.router.get_socket(fn)
+            resp_from, node = add, add[0]
+
+        if end:
+            pending = self.complete(sock_info, iid, None)
+            if pending is not None:
+                response_fn, req_from, rid, group = pending[0], pending[1], pending[2], pending[6]
+                self.deliver(response_fn, req_from, [self.PROCESS_RESPONSE_CHUNK, chunk, True, rid], resp_from)
+                for waiter_fn, waiter_from, waiter_rid in (() if group is None else self.release(group)):
+                    self.deliver(waiter_fn, waiter_from, [self.PROCESS_RESPONSE_CHUNK, chunk, True, waiter_rid], resp_from)
+            return
+
+        try:
+            response_fn, req_from, rid, route, started, trace, group = sock_info["responses"][iid]
+        except KeyError:
+            logging.warning("Unexpected response id: %s" % iid)
+            return
+        if group is not None and not self.win(group, sock_info["responses"]):
+            return
+
+        stream = self._streams.get((response_fn, rid))
+        if stream is None:
+            stream = self._streams[response_fn, rid] = {
+                "fn": fn,
+                "node": node,
+                "iid": iid,
+                "credit": self.stream_window,
+            }
+        stream["credit"] -= 1
+        if stream["credit"] < 0:
+            logging.warning("Stream window exceeded by %s: %s" % (resp_from, route.name))
+            self.fail_response(sock_info["responses"].pop(iid), RouteException("Stream window exceeded"), sock_info["responses"])
+            return
+
+        self.deliver(response_fn, req_from, [self.PROCESS_RESPONSE_CHUNK, chunk, False, rid], resp_from)
+        if group is not None:
+            # Callers that haven't joined before the first chunk would miss it, the next ones send their own request
+            # Stream credit of the first caller paces the others
+            for waiter_fn, waiter_from, waiter_rid in self.release(group):
+                self.deliver(waiter_fn, waiter_from, [self.PROCESS_RESPONSE_CHUNK, chunk, False, waiter_rid], resp_from)
+
+    def process_credit(self, fn, data, add=None):
+        """
+        Caller allows more chunks of a streamed response
+        """
+        rid, credit = data
+        if add is None:
+            req_from = self.router.get_socket(fn)["principal"]
+        else:
+            # Credit for a stream passing through the caller's node link
+            fn = self.router.get_handler(self.router.SOCK_NODE).get_node(add[0])
+            req_from = add
+
+        stream = self._streams.get((fn, rid))
+        if stream is None:
+            logging.debug("Credit for unknown stream: %s" % rid)
+            return
+        stream["credit"] += int(credit)
+
+        frame = [self.PROCESS_CREDIT, stream["iid"], int(credit)]
+        if stream["node"] is None:
+            self.router.get_socket(stream["fn"])["send_data"].append(frame)
+            self.router.epollout(stream["fn"])
         else:
-            from_service = self.get_service_by_socket(fn)
             handler = self.router.get_handler(self.router.SOCK_NODE)
-            resp_from = self.router.name, from_service[0], from_service[1]
-            handler.process(response_fn, [
+            handler.process(stream["fn"], [
                 handler.PROCESS_PROXY,
-                req_from[0],
-                resp_from,
-                [self.PROCESS_RESPONSE, response, error, rid],
+                stream["node"],
+                req_from,
+                frame,
                 self.router.generate_id(),
             ])
 
-        del sock_info["responses"][rid]
-
-    def put_service(self, service, instance, fn):
+    def process_stats(self, fn, data, add=None):
+        rid, = data
+        self.kernel_frame(fn, add, "stats", {}, rid)
+
+    def process_profile(self, fn, data, add=None):
+        settings, rid = data
+        self.kernel_frame(fn, add, "profile", settings, rid)
+
+    def kernel_frame(self, fn, add, method, kwargs, rid):
+        """
+        Frame of its own route case, answered as a request of the kernel method
+        Permissions are checked here even for proxied frames, as they don't pass the caller's node routing
+        """
+        req_from = self.router.get_socket(fn)["principal"] if add is None else add
+        route = self.kernel.stats.route(self.KERNEL, method)
+        route.requests += 1
         try:
-            self.get_service(service)
-        except RouteException:
-            self._services[service] = {instance: fn}
-            self.router.set_type_socket(fn, self.router.SOCK_SERVICE)
-            self._services_fn[fn] = (service, instance)
+            self.kernel.api.check(req_from[1], method)
+            self.kernel_request(fn, req_from, [None, method, None, kwargs, rid], route)
+        except Exception as e:
+            logging.debug(e)
+            route.errors += 1
+            self.respond(fn, req_from, None, error_data(e), rid)
+
+    def put_service(self, service, instance, fn, params=None):
+        """
+        Bind connection to the service instance
+        :param params: connect params, "session" resumes the previous session of the instance
+        :return: session id
+        """
+        params = {} if params is None else params
+        session_id = params.get("session")
+        session = self._sessions.get(session_id)
+        if session is not None and (session["service"], session["instance"]) != (service, instance):
+            session = None
+
+        if session is not None:
+            self._resume(session, fn, bool(params.get("resume")))
+            logging.info("Service `%s`[%i] resumed session" % (service, instance))
         else:
             try:
-                self.get_service(service, instance)
+                self.socket_close(self.get_service(service, instance))
             except RouteException:
                 pass
-            else:
-                self.socket_close(self._services[service][instance])
-            finally:
-                self._services[service][instance] = fn
-                self.router.set_type_socket(fn, self.router.SOCK_SERVICE)
-                self._services_fn[fn] = (service, instance)
+            # The new session supersedes the previous one of the instance
+            previous = self._instances_sessions.get((service, instance))
+            if previous is not None:
+                self._expire(previous)
+
+            session_id = binascii.hexlify(os.urandom(16)).decode("utf-8")
+            session = self._sessions[session_id] = {
+                "id": session_id,
+                "service": service,
+                "instance": instance,
+                "fn": None,
+                "parked": None,
+                "timer": None,
+            }
+            self._instances_sessions[service, instance] = session_id
+
+        session["fn"] = fn
+        if params.get("methods"):
+            self._policies[service] = params["methods"]
+            for key in [key for key in self._caches.keys() if key[0] == service]:
+                del self._caches[key]
+        sock_info = self.router.get_socket(fn)
+        sock_info["principal"] = (self.router.name, service, instance)
+        sock_info["batch"] = bool(params.get("batch"))
+        self._services.setdefault(service, {})[instance] = fn
+        self.router.set_type_socket(fn, self.router.SOCK_SERVICE)
+        # Read by wait_instances from another thread
+        with self._connected:
+            self._services_fn[fn] = (service, instance)
+            self._connected.notify_all()
+        return session_id
+
+    def wait_instances(self, instances, timeout=None):
+        """
+        Wait until service instances connect
+        :param instances: set of (service, instance)
+        :return: set of instances not connected
+        """
+        with self._connected:
+            self._connected.wait_for(lambda: instances <= set(self._services_fn.values()), timeout)
+            return instances - set(self._services_fn.values())
 
     def get_service(self, service, instance=None):
         try:
@@ -279,6 +1127,8 @@ class ServiceHandler(BaseHandler):
             with self._lock:
                 instances_names = list(instances.keys())
                 length = len(instances)
+                if length == 0:
+                    raise RouteException("Service doesn't exist")
                 counter = self._balancing_instances.get(service, -1) + 1
                 if counter >= length:
                     counter %= length
@@ -290,14 +1140,25 @@ class ServiceHandler(BaseHandler):
             except KeyError:
                 raise RouteException("Unexpected instance")
 
+    def get_parked(self, service, instance):
+        """
+        Get connection info kept for a reconnecting instance
+        """
+        for session in self._sessions.values():
+            if session["parked"] is None or session["service"] != service:
+                continue
+            if instance == self.BALANCED_INSTANCE or session["instance"] == instance:
+                return session["parked"]
+        raise RouteException("Service doesn't exist" if instance == self.BALANCED_INSTANCE else "Unexpected instance")
+
     def del_service(self, service, instance):
         try:
-            fn = self._services[service][instance]
-            self.socket_close(fn)
-            del self._services_fn[fn]
+            self.socket_close(self._services[service][instance])
         except KeyError:
             pass
-        del self._services[service][instance]
+        session_id = self._instances_sessions.get((service, instance))
+        if session_id is not None:
+            self._expire(session_id)
 
     def get_service_by_socket(self, fn):
         return self._services_fn[fn]
@@ -306,12 +1167,17 @@ class ServiceHandler(BaseHandler):
 class NodeHandler(BaseHandler):
     PROCESS_PROXY = "proxy"
     PROCESS_PROXY_STATUS = "proxy_status"
+    PROCESS_EVENTS = "events"
+
+    BATCHED = (PROCESS_PROXY,)
 
     def __init__(self, router):
         super().__init__(router)
         self.binds = {
             self.PROCESS_PROXY: self.process_proxy,
+            self.PROCESS_BATCH: self.process_batch,
             self.PROCESS_PROXY_STATUS: self.process_proxy_status,
+            self.PROCESS_EVENTS: self.process_events,
         }
         self._nodes = {}
         self._nodes_fn = {}
@@ -320,34 +1186,58 @@ class NodeHandler(BaseHandler):
     def socket_close(self, fn):
         node = self.get_node_by_socket(fn)
         logging.info("Closed connection with node `%s`" % node)
+        sock_info = self.router.get_socket(fn)
+        del self._nodes_fn[fn]
+        if self._nodes.get(node) == fn:
+            del self._nodes[node]
         super().socket_close(fn)
 
+        services_handler = self.router.get_handler(self.router.SOCK_SERVICE)
+        services_handler.fail_pending(sock_info, NodeException("Node disconnected"))
+        services_handler.rebind_callers(fn, None)
+
     def process_proxy(self, fn, data, _=None):
-        node, req_from, command, rid = data
+        node, req_from, command, rid = data[:4]
         if node == self.router.name:
             handler = self.router.get_handler(self.router.SOCK_SERVICE)
-            handler.process(fn, command, req_from)
+            handler.remote_perms = data[4] if len(data) > 4 else None
+            try:
+                handler.process(fn, command, req_from)
+            finally:
+                handler.remote_perms = None
         else:
             proxy_node = self.get_node(node)
             sock_info = self.router.get_socket(proxy_node)
-            sock_info["send_data"].append([
-                self.PROCESS_PROXY,
-                node,
-                req_from,
-                command,
-                rid,
-            ])
+            data.insert(0, self.PROCESS_PROXY)
+            sock_info["send_data"].append(data)
             self.router.epollout(proxy_node)
 
     def process_proxy_status(self, fn, data, _=None):
         error, rid = data
 
+    def process_events(self, fn, data, _=None):
+        events, = data
+        for eid, name, event_data, visited in events:
+            self.kernel.event.receive(eid, name, event_data, visited)
+
+    def send(self, node, frame):
+        node_fn = self.get_node(node)
+        self.router.get_socket(node_fn)["send_data"].append(frame)
+        self.router.epollout(node_fn)
+
     def put_node(self, node, fn):
         try:
-            self.get_node(node)
-            self.socket_close(self._nodes[node])
+            old_fn = self.get_node(node)
         except RouteException:
             pass
+        else:
+            # Responses pending on the replaced link are still expected from that node
+            old_sock_info = self.router.get_socket(old_fn)
+            sock_info = self.router.get_socket(fn)
+            sock_info["responses"].update(old_sock_info["responses"])
+            sock_info["ids"] = old_sock_info["ids"]
+            old_sock_info["responses"].clear()
+            self.socket_close(old_fn)
 
         self._nodes[node] = fn
         self.router.set_type_socket(fn, self.router.SOCK_NODE)
@@ -359,24 +1249,107 @@ class NodeHandler(BaseHandler):
         except KeyError:
             raise RouteException("Node doesn't exist")
 
+    def nodes(self):
+        return self._nodes.keys()
+
     def del_node(self, node):
         try:
-            fn = self._nodes[node]
-            self.socket_close(fn)
-            del self._nodes_fn[fn]
+            self.socket_close(self._nodes[node])
         except KeyError:
             pass
-        del self._nodes[node]
 
     def get_node_by_socket(self, fn):
         return self._nodes_fn[fn]
 
+    def export(self):
+        return dict(self._nodes)
+
+    def adopt(self, state, fns):
+        for node, fn in state.items():
+            if fn in fns:
+                self.put_node(node, fns[fn])
+
+
+class SendQueue(object):
+    """
+    Outgoing frames of a connection, queued by priority class and served by weighted round robin
+    """
+
+    # Frames taken from a class in one round
+    WEIGHTS = (8, 4, 1)
+
+    __slots__ = ("router", "queues", "_current", "_deficit", "_length")
+
+    def __init__(self, router):
+        self.router = router
+        self.queues = tuple(collections.deque() for _ in self.WEIGHTS)
+        self._current = 0
+        self._deficit = self.WEIGHTS[0]
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return itertools.chain(*self.queues)
+
+    def append(self, frame, priority=None):
+        """
+        :param priority: class, priority of the frame being processed by default
+        """
+        self.queues[self.router.priority if priority is None else priority].append(frame)
+        self._length += 1
+
+    def extend(self, frames, priority=None):
+        for frame in frames:
+            self.append(frame, priority)
+
+    def merge(self, other):
+        """
+        Move frames of another queue to the end of this one, keeping their classes
+        """
+        for queue, other_queue in zip(self.queues, other.queues):
+            queue.extend(other_queue)
+            other_queue.clear()
+        self._length += other._length
+        other._length = 0
+
+    def _next(self):
+        while len(self.queues[self._current]) == 0 or self._deficit <= 0:
+            self._current = (self._current + 1) % len(self.queues)
+            self._deficit = self.WEIGHTS[self._current]
+        return self.queues[self._current]
+
+    def peek(self):
+        return self._next()[0]
+
+    def popleft(self):
+        queue = self._next()
+        self._deficit -= 1
+        self._length -= 1
+        return queue.popleft()
+
 
 class Router(object):
     SOCK_REG = 0
     SOCK_SERVICE = 1
     SOCK_NODE = 2
 
+    ID_MASK = 0xffffffffffffffff
+
+    PRIORITY_REALTIME = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_BATCH = 2
+
+    PRIORITIES = {
+        "realtime": PRIORITY_REALTIME,
+        "normal": PRIORITY_NORMAL,
+        "batch": PRIORITY_BATCH,
+    }
+
+    # Frames read from a connection per loop iteration
+    READ_BUDGET = (16, 8, 2)
+
     def __init__(self, rpc):
         self.rpc = rpc
         self.kernel = self.rpc.kernel
@@ -384,6 +1357,11 @@ class Router(object):
         # self.name = self.kernel.l.get("kernel/env", keys=["name"])["name"]
         self.name = self.kernel.env["CE_NODE_NAME"]
         self._sockets = {}
+        self._ids = itertools.count(1)
+        # Trace of the frame being processed
+        self.trace = None
+        # Priority class of the frame being processed, frames it produces are queued with it
+        self.priority = self.PRIORITY_NORMAL
         self._handlers = {
             self.SOCK_REG: RegularHandler(self),
             self.SOCK_SERVICE: ServiceHandler(self),
@@ -392,26 +1370,65 @@ class Router(object):
 
     def add_socket(self, sock, address, sock_type=None):
         sock_type = self.SOCK_REG if sock_type is None else sock_type
-        # [socket, address, type, send_data, responses]
         self.rpc.epoll.register(sock, select.EPOLLIN)
-        self._sockets[sock.fileno()] = [sock, address, sock_type, [], {}]
-
-    def get_socket(self, fn):
-        sock, address, sock_type, send_data, responses = self._sockets[fn]
-        return {
-            "socket": sock,
+        stats = ConnectionStats()
+        self._sockets[sock.fileno()] = {
+            "socket": MeteredSocket(sock, stats),
             "address": address,
             "type": sock_type,
-            "send_data": send_data,
-            "responses": responses,
+            "send_data": SendQueue(self),
+            "priority": self.PRIORITY_NORMAL,
+            # Address of the authenticated service
+            "principal": None,
+            # Connection accepts batch frames
+            "batch": False,
+            # internal id -> (caller fn, caller address, caller rid, route stats, start time, trace, group)
+            "responses": {},
+            "ids": itertools.count(1),
+            "stats": stats,
         }
 
+    def get_socket(self, fn):
+        return self._sockets[fn]
+
+    def priority_class(self, priority):
+        """
+        :param priority: class name, unknown or None for normal
+        """
+        return self.PRIORITIES.get(priority, self.PRIORITY_NORMAL)
+
+    def event_priority(self, event):
+        """
+        Sort key of polled events, listening and wakeup descriptors come first
+        """
+        sock_info = self._sockets.get(event[0])
+        return self.PRIORITY_REALTIME if sock_info is None else sock_info["priority"]
+
+    def sockets(self):
+        return list(self._sockets.items())
+
     def set_type_socket(self, fn, t):
-        self._sockets[fn][2] = t
+        self._sockets[fn]["type"] = t
 
     def del_socket(self, fn):
         del self._sockets[fn]
 
+    def bind_response(self, sock_info, fn, req_from, rid, route, group=None):
+        """
+        Map caller's request id to an id unique for the requested connection
+        :param sock_info: connection the request is sent to
+        :param fn: caller's connection
+        :param req_from: caller's address
+        :param rid: caller's request id
+        :param route: route stats of the request
+        :param group: attempts of a hedged or retried request
+        :return: internal request id
+        """
+        iid = next(sock_info["ids"]) & self.ID_MASK
+        route.in_flight += 1
+        sock_info["responses"][iid] = (fn, req_from, rid, route, time.perf_counter(), self.trace, group)
+        return iid
+
     def get_handler(self, t):
         return self._handlers[t]
 
@@ -434,14 +1451,62 @@ class Router(object):
             logging.exception(e)
             handler.socket_close(file_no)
 
+    def is_socket(self, fn, sock_info):
+        """
+        Connection is still open and its descriptor has not been reused
+        """
+        return self._sockets.get(fn) is sock_info
+
+    def pause(self, fn):
+        """
+        Stop polling the connection, only hang up is reported
+        """
+        self.rpc.epoll.modify(fn, 0)
+
     def epollin(self, fn):
-        self.rpc.epoll.modify(fn, select.EPOLLIN)
+        # Draining kernel only reads connections it waits for responses from
+        if self.rpc.draining and len(self._sockets[fn]["responses"]) == 0:
+            self.pause(fn)
+        else:
+            self.rpc.epoll.modify(fn, select.EPOLLIN)
 
     def epollout(self, fn):
         self.rpc.epoll.modify(fn, select.EPOLLOUT)
 
     def generate_id(self):
-        return "%s" % (time.time())
+        return next(self._ids) & self.ID_MASK
+
+    def quiesce(self):
+        """
+        Stop reading authed connections no response is expected from
+        """
+        for fn, sock_info in self._sockets.items():
+            if sock_info["type"] == self.SOCK_REG:
+                continue
+            if len(sock_info["responses"]) == 0 and len(sock_info["send_data"]) == 0:
+                self.pause(fn)
+
+    def idle(self):
+        """
+        No request is pending and nothing is queued
+        """
+        if not self.get_handler(self.SOCK_SERVICE).idle():
+            return False
+        for sock_info in self._sockets.values():
+            if len(sock_info["responses"]) > 0 or len(sock_info["send_data"]) > 0:
+                return False
+        return True
+
+    def flush(self):
+        """
+        Write queued frames of all connections
+        """
+        for fn, sock_info in self.sockets():
+            if len(sock_info["send_data"]) > 0:
+                try:
+                    self.get_handler(sock_info["type"]).socket_send(fn)
+                except Exception as e:
+                    logging.exception(e)
 
     def stop(self):
         for fn in self._sockets.copy().keys():
@@ -455,6 +1520,17 @@ class Router(object):
 
 class Rpc(KernelModule):
     _stop = None
+    _timers = None
+    _timers_ids = None
+    _callbacks = None
+    _wakeup = None
+    _handoff = None
+    ready = None
+    executor = None
+    # Connections are being handed over to another kernel, new requests are rejected
+    draining = False
+    # Connections have been taken over from the previous kernel
+    adopted = False
 
     socket = None
     router = None
@@ -463,6 +1539,11 @@ class Rpc(KernelModule):
     host = "0.0.0.0"
     port = 2011
 
+    # Drain progress check interval, seconds
+    DRAIN_INTERVAL = 0.05
+    # Descriptors passed in one message, SCM_RIGHTS allows 253
+    HANDOFF_FDS = 250
+
     def init(self, *args, **kwargs):
         super().init(*args, **kwargs)
         self.router = Router(self)
@@ -470,24 +1551,56 @@ class Rpc(KernelModule):
         self.port = self.port if kwargs.get("port") is None else int(kwargs.get("port"))
         self._stop = False
         self._alive = None
+        self._timers = []
+        self._timers_ids = itertools.count()
+        self._callbacks = collections.deque()
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            os.set_blocking(fd, False)
+        self.ready = threading.Event()
+        self.connect_timeout = float(self.kernel.env.get("CE_NODE_CONNECT_TIMEOUT", 2))
+        self.drain_timeout = float(self.kernel.env.get("CE_DRAIN_TIMEOUT", 30))
+        # Registry and Docker calls of the router never run on the RPC thread
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(self.kernel.env.get("CE_RPC_WORKERS", 4)),
+            thread_name_prefix="kernel.rpc.io",
+        )
 
     def serve(self):
         logging.info("Starting server (%s:%i)" % (self. host, self.port))
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind((self.host, int(self.port)))
-        self.socket.listen(1)
-        self.socket.setblocking(0)
-
-        self.epoll = select.epoll()
-        self.epoll.register(self.socket.fileno(), select.EPOLLIN)
-        self._alive = True
+        try:
+            self.epoll = select.epoll()
+            self.epoll.register(self._wakeup[0], select.EPOLLIN)
+
+            path = self.kernel.env.get("CE_HANDOFF")
+            self.adopted = path is not None and self.adopt(path)
+            if not self.adopted:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.socket.bind((self.host, int(self.port)))
+                self.socket.listen(1)
+            self.socket.setblocking(0)
+            self.epoll.register(self.socket.fileno(), select.EPOLLIN)
+        except Exception:
+            self._alive = False
+            raise
+        else:
+            self._alive = True
+        finally:
+            self.ready.set()
 
+        stats = self.kernel.stats
+        profiler = self.kernel.profiler
         try:
             while self.alive:
-                events = self.epoll.poll(1)
+                events = self.epoll.poll(self.poll_timeout())
+                started = time.perf_counter()
+                if len(events) > 1:
+                    events.sort(key=self.router.event_priority)
                 for file_no, event in events:
-                    if file_no == self.socket.fileno():
+                    if file_no == self._wakeup[0]:
+                        self._drain_wakeup()
+                    elif file_no == self.socket.fileno():
                         try:
                             connection, address = self.socket.accept()
                             self.router.add_socket(sock=connection, address=address)
@@ -498,6 +1611,10 @@ class Rpc(KernelModule):
                             self.router.epoll(event, file_no)
                         except Exception as e:
                             logging.exception(e)
+                self.run_callbacks()
+                self.run_timers()
+                stats.loop_iteration(len(events), time.perf_counter() - started)
+                profiler.tick()
         except Exception as e:
             self.stop()
             if self.alive:
@@ -506,30 +1623,292 @@ class Rpc(KernelModule):
         else:
             self.stop()
 
+    def call_soon(self, callback, *args):
+        """
+        Run callback on the RPC thread, safe to call from any thread
+        """
+        self._callbacks.append((callback, args))
+        try:
+            os.write(self._wakeup[1], b"\0")
+        except BlockingIOError:
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup[0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def run_callbacks(self):
+        callbacks = self._callbacks
+        while len(callbacks) > 0:
+            callback, args = callbacks.popleft()
+            try:
+                callback(*args)
+            except Exception as e:
+                logging.exception(e)
+
+    def submit(self, function, args, callback, *callback_args):
+        """
+        Run blocking function on the executor
+        :param callback: callable(result, exception, *callback_args), called from the RPC thread
+        """
+        def call():
+            try:
+                result = function(*args)
+            except Exception as e:
+                self.call_soon(callback, None, e, *callback_args)
+            else:
+                self.call_soon(callback, result, None, *callback_args)
+        return self.executor.submit(call)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedule callback on the RPC thread
+        :param delay: delay in seconds
+        :return: timer to cancel
+        """
+        timer = [time.monotonic() + delay, next(self._timers_ids), callback, args, False]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        timer[4] = True
+
+    def poll_timeout(self):
+        if len(self._callbacks) > 0:
+            return 0
+        if len(self._timers) == 0:
+            return 1
+        return min(max(self._timers[0][0] - time.monotonic(), 0), 1)
+
+    def run_timers(self):
+        now = time.monotonic()
+        while len(self._timers) > 0 and self._timers[0][0] <= now:
+            _, _, callback, args, cancelled = heapq.heappop(self._timers)
+            if cancelled:
+                continue
+            try:
+                callback(*args)
+            except Exception as e:
+                logging.exception(e)
+
     def node(self, node):
+        """
+        Connect to node, blocking part runs in the calling thread
+        :return: bool
+        """
         try:
             self_node = self.router.name
             node_data = self.kernel.g.get("kernel/nodes", keys=[node]).get(node)
             self_node_data = self.kernel.g.get("kernel/nodes", keys=[self_node]).get(self_node)
             address = tuple(node_data["address"])
-            connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            connection.connect(address)
-            self.router.add_socket(sock=connection, address=address, sock_type=self.router.SOCK_NODE)
-            fn = connection.fileno()
-            self.router.get_handler(self.router.SOCK_NODE).put_node(node, fn)
-            sock_info = self.router.get_socket(fn)
-            token = self_node_data["token"]
-
-            sock_info["send_data"].append([
-                RegularHandler.PROCESS_NODE,
-                self_node,
-                token,
-                {},
-            ])
-            self.router.epollout(fn)
+            connection = socket.create_connection(address, timeout=self.connect_timeout)
+            connection.settimeout(None)
         except Exception as e:
             logging.exception(e)
+            return False
+
+        self.call_soon(self._add_node, node, connection, address, self_node_data["token"])
+        return True
+
+    def _add_node(self, node, connection, address, token):
+        self.router.add_socket(sock=connection, address=address, sock_type=self.router.SOCK_NODE)
+        fn = connection.fileno()
+        self.router.get_handler(self.router.SOCK_NODE).put_node(node, fn)
+        sock_info = self.router.get_socket(fn)
+
+        sock_info["send_data"].append([
+            RegularHandler.PROCESS_NODE,
+            self.router.name,
+            token,
+            {"batch": True},
+        ])
+        self.router.epollout(fn)
+
+    def drain(self, path, callback):
+        """
+        Stop taking new connections and requests, hand connections over to a new kernel process
+        once the requests in flight are answered or CE_DRAIN_TIMEOUT passes
+        :param path: unix socket the new kernel connects to
+        :param callback: called after the handoff, from the RPC thread
+        """
+        if self.draining:
+            return
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        listener.bind(path)
+        listener.listen(1)
+        listener.setblocking(False)
+        self._handoff = {"path": path, "listener": listener, "peer": None}
+
+        logging.info("Draining connections, waiting for the new kernel at %s" % path)
+        self.draining = True
+        # Connections keep queueing in the backlog of the listening socket until the new kernel accepts them
+        self.epoll.unregister(self.socket.fileno())
+        self._drain(time.monotonic() + self.drain_timeout, callback)
+
+    def _drain(self, deadline, callback):
+        if not self.draining:
+            return
+        if self._handoff["peer"] is None:
+            try:
+                self._handoff["peer"] = self._handoff["listener"].accept()[0]
+            except BlockingIOError:
+                pass
+
+        self.router.quiesce()
+        expired = time.monotonic() >= deadline
+        if self._handoff["peer"] is not None and (expired or self.router.idle()):
+            try:
+                self.handoff(self._handoff["peer"])
+            except Exception as e:
+                logging.exception(e)
+                self.resume()
+                return
+            callback()
+        elif expired:
+            logging.error("No kernel has taken connections over, resuming")
+            self.resume()
+        else:
+            self.call_later(self.DRAIN_INTERVAL, self._drain, deadline, callback)
+
+    def handoff(self, peer):
+        """
+        Send listening socket and authed connections with their route tables to the new kernel
+        """
+        services_handler = self.router.get_handler(self.router.SOCK_SERVICE)
+        services_handler.abandon(DrainException("Kernel restarted"))
+        self.router.flush()
+
+        sockets, fds = [], [self.socket.fileno()]
+        for fn, sock_info in self.router.sockets():
+            if sock_info["type"] == self.router.SOCK_REG:
+                continue
+            sockets.append({
+                "fn": fn,
+                "address": sock_info["address"],
+                "type": sock_info["type"],
+                "priority": sock_info["priority"],
+                "principal": sock_info["principal"],
+                "batch": sock_info["batch"],
+                # Ids of requests the peer still has to answer mustn't be reused by the new kernel
+                "ids": next(sock_info["ids"]),
+            })
+            fds.append(fn)
+        data = json.dumps({
+            "sockets": sockets,
+            "services": services_handler.export(),
+            "nodes": self.router.get_handler(self.router.SOCK_NODE).export(),
+        }).encode("utf-8")
+
+        peer.setblocking(True)
+        peer.settimeout(self.drain_timeout)
+        peer.sendall(struct.pack("!I", len(data)) + data)
+        for i in range(0, len(fds), self.HANDOFF_FDS):
+            peer.sendmsg([b"\0"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds[i:i + self.HANDOFF_FDS]))])
+        if self._recv_exact(peer, 1) != b"\1":
+            raise RpcException("Handoff is not acknowledged")
+
+        # Descriptors are closed only in this process, connections stay open in the new kernel
+        for fn in fds[1:]:
+            sock = self.router.get_socket(fn)["socket"]
+            self.epoll.unregister(fn)
+            self.router.del_socket(fn)
+            sock.close()
+        self._close_handoff()
+        logging.info("Handed %i connections over to the new kernel" % len(sockets))
+
+    def resume(self):
+        """
+        Serve connections again after a failed handoff
+        """
+        self._close_handoff()
+        self.draining = False
+        self.epoll.register(self.socket.fileno(), select.EPOLLIN)
+        for fn, sock_info in self.router.sockets():
+            # Connections being authed are polled again by their auth callbacks
+            if sock_info["type"] == self.router.SOCK_REG:
+                continue
+            if len(sock_info["send_data"]) > 0:
+                self.router.epollout(fn)
+            else:
+                self.router.epollin(fn)
+
+    def _close_handoff(self):
+        handoff, self._handoff = self._handoff, None
+        if handoff is None:
+            return
+        for sock in [handoff["peer"], handoff["listener"]]:
+            if sock is not None:
+                sock.close()
+        try:
+            os.unlink(handoff["path"])
+        except FileNotFoundError:
+            pass
+
+    def adopt(self, path):
+        """
+        Take listening socket and connections over from the kernel draining at path
+        :return: bool, False when no kernel is draining there
+        """
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(path)
+        except OSError:
+            conn.close()
+            return False
+
+        with conn:
+            conn.settimeout(self.drain_timeout + self.connect_timeout)
+            size, = struct.unpack("!I", self._recv_exact(conn, 4))
+            state = json.loads(self._recv_exact(conn, size).decode("utf-8"))
+            fds = self._recv_fds(conn, len(state["sockets"]) + 1)
+
+            self.socket = socket.socket(fileno=fds[0])
+            fns = {}
+            for entry, fd in zip(state["sockets"], fds[1:]):
+                sock = socket.socket(fileno=fd)
+                sock.setblocking(True)
+                self.router.add_socket(sock=sock, address=tuple(entry["address"]), sock_type=entry["type"])
+                sock_info = self.router.get_socket(fd)
+                sock_info["priority"] = entry["priority"]
+                sock_info["principal"] = None if entry["principal"] is None else tuple(entry["principal"])
+                sock_info["batch"] = entry["batch"]
+                sock_info["ids"] = itertools.count(entry.get("ids", 1))
+                fns[entry["fn"]] = fd
+            self.router.get_handler(self.router.SOCK_SERVICE).adopt(state["services"], fns)
+            self.router.get_handler(self.router.SOCK_NODE).adopt(state["nodes"], fns)
+            conn.sendall(b"\1")
+
+        logging.info("Took %i connections over from the previous kernel" % len(fns))
+        return True
+
+    @staticmethod
+    def _recv_exact(conn, size):
+        data = b""
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise RpcException("Handoff connection closed")
+            data += chunk
+        return data
+
+    def _recv_fds(self, conn, count):
+        fds = array.array("i")
+        while len(fds) < count:
+            msg, ancdata, _, _ = conn.recvmsg(1, socket.CMSG_SPACE(self.HANDOFF_FDS * fds.itemsize))
+            if not msg:
+                raise RpcException("Handoff connection closed")
+            for level, kind, cmsg in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds.frombytes(cmsg[:len(cmsg) - len(cmsg) % fds.itemsize])
+        return list(fds)
 
     def stop(self):
         if self._stop:
@@ -541,10 +1920,12 @@ class Rpc(KernelModule):
         except Exception as e:
             logging.exception(e)
 
-        try:
-            self.epoll.unregister(self.socket.fileno())
-        except Exception as e:
-            logging.exception(e)
+        # Listening socket isn't polled while draining
+        if not self.draining:
+            try:
+                self.epoll.unregister(self.socket.fileno())
+            except Exception as e:
+                logging.exception(e)
         try:
             self.epoll.close()
         except Exception as e:
@@ -557,3 +1938,4 @@ class Rpc(KernelModule):
     def exit(self, *args, **kwargs):
         super().exit(*args, **kwargs)
         self.stop()
+        self.executor.shutdown(wait=False)
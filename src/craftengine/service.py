@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 __author__ = "Alexey Kachalov"
 
+import collections
 import logging
 import socket
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from craftengine.modules import KernelModule
 from craftengine.exceptions import KernelException
@@ -21,12 +24,65 @@ class CollisionException(ServiceException):
 
 
 class Service(KernelModule):
+    OP_START = "start"
+    OP_STOP = "stop"
+    OP_REMOVE = "remove"
+    OP_WARM = "warm"
+
+    STATE_RUNNING = "running"
+    STATE_EXITED = "exited"
+
+    _executor = None
+    # service -> {"parallel", "running", "queue"}, operations wait here instead of holding pool workers
+    _slots = None
+    _lock = None
+    # service -> {instance: {"id": container id, "state": state}}
+    _index = None
+    _stopping = None
+    # service -> {instance: (container name, image)}
+    _pool = None
+
+    def init(self, *args, **kwargs):
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(self.kernel.env.get("CE_DOCKER_WORKERS", 8)),
+            thread_name_prefix="kernel.docker",
+        )
+        self._slots = {}
+        self._lock = threading.Lock()
+        self._index = None
+        self._stopping = set()
+        self._pool = {}
+
     def is_service(self, service):
         return service in self.list().keys()
 
     def service_name(self, service, num):
         return "ce_%s_%s_service_%i_%s" % (self.kernel.env["CE_PROJECT_NAME"], self.kernel.env["CE_NODE_NAME"], num, service)
 
+    def warm_name(self, service, num):
+        return "ce_%s_%s_warm_%i_%s" % (self.kernel.env["CE_PROJECT_NAME"], self.kernel.env["CE_NODE_NAME"], num, service)
+
+    def identify(self, labels, name):
+        """
+        Service instance of a container
+        :param labels: container labels
+        :param name: container name
+        :return: (service, instance) or None for other nodes' and warm containers
+        """
+        node = labels.get("Node")
+        if node is not None and node != self.kernel.env["CE_NODE_NAME"]:
+            return None
+
+        service, num = labels.get("Service"), labels.get("Instance")
+        if service is None or num is None:
+            # Containers created before the instance label was set or taken from the warm pool
+            prefix = self.service_name("", 0)[:-len("0_")]
+            name = name.lstrip("/")
+            if not name.startswith(prefix):
+                return None
+            num, service = name[len(prefix):].split("_", 1)
+        return service, int(num)
+
     def list(self):
         try:
             return self.kernel.l.get("kernel/services")
@@ -34,6 +90,180 @@ class Service(KernelModule):
             self.kernel.l.create("kernel/services")
             return {}
 
+    def save(self, service, service_info):
+        self.kernel.l.set("kernel/services", keys={service: service_info}, trusted=True)
+        self.kernel.permissions.update(service, service_info)
+        self.kernel.limits.update(service, service_info)
+
+    def index(self, service=None):
+        """
+        Containers of this node's services
+        :param service: service name
+        :return: {instance: {"id", "state"}} of the service or {service: ...} of all services
+        """
+        with self._lock:
+            if self._index is None:
+                self._index = self._build_index()
+            if service is None:
+                return {k: dict(v) for k, v in self._index.items()}
+            return dict(self._index.get(service, {}))
+
+    def _build_index(self):
+        index = {}
+        for container in self.kernel.docker.containers(all=True, filters={"label": "CRAFTEngine=True"}):
+            names = container.get("Names") or [""]
+            instance = self.identify(container.get("Labels") or {}, names[0])
+            if instance is None:
+                continue
+
+            state = container.get("State")
+            if state is None:
+                state = self.STATE_RUNNING if container.get("Status", "").startswith("Up") else self.STATE_EXITED
+            index.setdefault(instance[0], {})[instance[1]] = {"id": container["Id"], "state": state}
+        return index
+
+    def index_update(self, service, num, container_id=None, state=None):
+        """
+        Update container index
+        :param state: container state, None removes the container
+        """
+        with self._lock:
+            if self._index is None:
+                return
+            instances = self._index.setdefault(service, {})
+            current = instances.get(num)
+            if container_id is not None and current is not None and current["id"] != container_id \
+                    and state != self.STATE_RUNNING:
+                # Event of a replaced container
+                return
+            if state is None:
+                instances.pop(num, None)
+            else:
+                container = instances.setdefault(num, {"id": container_id, "state": state})
+                container["state"] = state
+                if container_id is not None:
+                    container["id"] = container_id
+
+    def index_event(self, event):
+        """
+        Apply Docker event to container index
+        :param event: decoded event of Docker events API
+        """
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        instance = self.identify(attributes, attributes.get("name", ""))
+        if instance is None:
+            return
+
+        service, num = instance
+        action = event.get("Action", event.get("status"))
+        container_id = event.get("id")
+        if action == "start":
+            self.index_update(service, num, container_id, self.STATE_RUNNING)
+        elif action in ["die", "stop", "kill", "oom"]:
+            self.index_update(service, num, container_id, self.STATE_EXITED)
+        elif action == "destroy":
+            self.index_update(service, num, container_id)
+
+    def is_stopping(self, service, num):
+        """
+        Instance was stopped or removed by the kernel
+        """
+        return (service, num) in self._stopping
+
+    def is_current(self, service, num, container_id):
+        """
+        Container is the one the index holds for the instance, not a replaced one
+        """
+        return self.index(service).get(num, {}).get("id") == container_id
+
+    def _slot(self, service, service_info):
+        try:
+            return self._slots[service]
+        except KeyError:
+            parallel = service_info.get("parallel", self.kernel.env.get("CE_SERVICE_PARALLEL", 4))
+            slot = self._slots[service] = {"parallel": int(parallel), "running": 0, "queue": collections.deque()}
+            return slot
+
+    def _feed(self, service):
+        """
+        Pass queued operations of the service to the pool, up to its "parallel" limit
+        """
+        while True:
+            with self._lock:
+                slot = self._slots[service]
+                if slot["running"] >= slot["parallel"] or len(slot["queue"]) == 0:
+                    return
+                slot["running"] += 1
+                future, args = slot["queue"].popleft()
+            try:
+                self._executor.submit(self._run, future, args)
+            except RuntimeError as e:
+                # Pool has been shut down
+                with self._lock:
+                    slot["running"] -= 1
+                future.set_exception(e)
+
+    def _run(self, future, args):
+        service = args[1]
+        try:
+            if future.set_running_or_notify_cancel():
+                future.set_result(self._execute(*args))
+        finally:
+            with self._lock:
+                self._slots[service]["running"] -= 1
+            self._feed(service)
+
+    def _execute(self, operation, service, num, service_info, *args):
+        handler = {
+            self.OP_START: self._start,
+            self.OP_STOP: self._stop,
+            self.OP_REMOVE: self._remove,
+            self.OP_WARM: self._warm,
+        }[operation]
+
+        try:
+            handler(service, num, service_info, *args)
+        except Exception as e:
+            logging.exception("Error: %s service '%s'[%i]" % (operation, service, num))
+            error = "%s: %s" % (e.__class__.__name__, e)
+        else:
+            error = None
+
+        return {
+            "service": service,
+            "instance": num,
+            "operation": operation,
+            "success": error is None,
+            "error": error,
+        }
+
+    def submit(self, operation, service, instances, *args, service_info=None):
+        """
+        Run container operation for each instance on the kernel's pool,
+        at most "parallel" operations of the service at once
+        :param operation: OP_START, OP_STOP or OP_REMOVE
+        :param instances: instance numbers
+        :param service_info: service registry entry
+        :return: list of futures of operation results
+        """
+        service_info = self.list()[service] if service_info is None else service_info
+        instances = list(instances)
+        futures = [Future() for _ in instances]
+        with self._lock:
+            queue = self._slot(service, service_info)["queue"]
+            for future, i in zip(futures, instances):
+                queue.append((future, (operation, service, i, service_info) + args))
+        self._feed(service)
+        return futures
+
+    @staticmethod
+    def wait(futures):
+        """
+        Wait operation results
+        :return: list of {"service", "instance", "operation", "success", "error"}
+        """
+        return [future.result() for future in futures]
+
     def start(self, service, num=None, force=None, remove=None):
         if not self.is_service(service):
             raise ServiceNotFoundException
@@ -42,10 +272,19 @@ class Service(KernelModule):
         force = True if force is None else bool(force)
         remove = True if remove is None else bool(remove)
 
-        for i in range(1, num + 1):
-            self._start(service, i, force, remove)
+        results = self.wait(self.submit(self.OP_START, service, range(1, num + 1), force, remove))
+        self.refill(service)
+        return results
+
+    def _start(self, service, num, service_info, force, remove):
+        # Replaced container dies on removal, that is not a crash to restart
+        self._stopping.add((service, num))
+        try:
+            self._replace(service, num, service_info, force, remove)
+        finally:
+            self._stopping.discard((service, num))
 
-    def _start(self, service, num, force, remove):
+    def _replace(self, service, num, service_info, force, remove):
         container_name = self.service_name(service, num)
         try:
             if remove:
@@ -53,94 +292,210 @@ class Service(KernelModule):
         except:
             logging.exception("")
 
-        service_info = self.list()[service]
+        warm = self._take_warm(service, num, service_info)
+        if warm is not None:
+            try:
+                self.kernel.docker.rename(container=warm, name=container_name)
+            except:
+                logging.exception("Could not take warm container of '%s'[%i]" % (service, num))
+            else:
+                self.kernel.docker.start(container=container_name)
+                self.index_update(service, num, self.kernel.docker.inspect_container(container_name)["Id"], self.STATE_RUNNING)
+                logging.info("'%s'[%i] service started from warm pool" % (service, num))
+                return
 
-        try:
-            self.kernel.docker.create_container(
-                image=service_info["image"],
-                detach=True,
-                name=container_name,
-                environment={
-                    "CE_TOKEN": service_info["token"],
-                    "CE_NAME": service,
-                    "CE_NODE": self.kernel.env["CE_NODE_NAME"],
-                    "CE_INSTANCE": num,
-                },
-                labels={
-                    "CRAFTEngine": "True",
-                    "Service": service,
+        container = self._create(service, num, service_info, container_name)
+        self.kernel.docker.start(container=container_name)
+        self.index_update(service, num, container.get("Id"), self.STATE_RUNNING)
+        logging.info("'%s'[%i] service started" % (service, num))
+
+    def _create(self, service, num, service_info, container_name, labels=None):
+        environment = {
+            "CE_TOKEN": service_info["token"],
+            "CE_NAME": service,
+            "CE_NODE": self.kernel.env["CE_NODE_NAME"],
+            "CE_INSTANCE": num,
+        }
+        # A restarted instance takes over requests queued for the previous one
+        session = self.kernel.rpc.router.get_handler(self.kernel.rpc.router.SOCK_SERVICE).get_session(service, num)
+        if session is not None:
+            environment["CE_SESSION"] = session
+
+        labels = {
+            "CRAFTEngine": "True",
+            "Service": service,
+            "Instance": str(num),
+        } if labels is None else labels
+        labels["Node"] = self.kernel.env["CE_NODE_NAME"]
+
+        return self.kernel.docker.create_container(
+            image=service_info["image"],
+            detach=True,
+            name=container_name,
+            environment=environment,
+            labels=labels,
+            host_config=self.kernel.docker.create_host_config(
+                links={
+                    socket.gethostname(): "ce-kernel",
                 },
-                host_config=self.kernel.docker.create_host_config(
-                    links={
-                        socket.gethostname(): "ce-kernel",
-                    },
-                ),
-            )
-            self.kernel.docker.start(container=container_name)
-            logging.info("'%s'[%i] service started" % (service, num))
+            ),
+        )
+
+    def _warm(self, service, num, service_info):
+        container_name = self.warm_name(service, num)
+        self._create(service, num, service_info, container_name, labels={
+            "CRAFTEngine": "True",
+            "Pool": service,
+            "Image": service_info["image"],
+        })
+        with self._lock:
+            self._pool.setdefault(service, {})[num] = container_name, service_info["image"]
+        logging.info("'%s'[%i] warm container created" % (service, num))
+
+    def _take_warm(self, service, num, service_info):
+        with self._lock:
+            warm = self._pool.get(service, {}).pop(num, None)
+        if warm is None:
+            return None
+
+        container_name, image = warm
+        if image != service_info["image"]:
+            self._executor.submit(self._remove_warm, container_name)
+            return None
+        return container_name
+
+    def _remove_warm(self, container_name):
+        try:
+            self.kernel.docker.remove_container(container=container_name, force=True)
         except:
-            logging.exception("")
+            logging.exception("Error removing warm container '%s'" % container_name)
+
+    def refill(self, service):
+        """
+        Keep warm containers for instances above the scale, the pool size is set by the service's "pool" field
+        """
+        self._executor.submit(self._refill, service)
+
+    def _refill(self, service):
+        try:
+            service_info = self.list().get(service)
+            size = 0 if service_info is None else int(service_info.get("pool", 0))
+            scale = 0 if service_info is None else service_info.get("scale", 1)
+            required = set(range(scale + 1, scale + size + 1))
+
+            with self._lock:
+                if service not in self._pool:
+                    # Warm containers left by the previous kernel
+                    pool = self._pool[service] = {}
+                    prefix = self.warm_name(service, 0)[:-len("0_%s" % service)]
+                    for container in self.kernel.docker.containers(all=True, filters={"label": [
+                        "Pool=%s" % service,
+                        "Node=%s" % self.kernel.env["CE_NODE_NAME"],
+                    ]}):
+                        name = (container.get("Names") or [""])[0].lstrip("/")
+                        # Taken containers keep the pool label
+                        if name.startswith(prefix):
+                            pool[int(name[len(prefix):].split("_", 1)[0])] = name, container["Labels"].get("Image")
+
+                pool = self._pool[service]
+                stale = [
+                    pool.pop(num)[0] for num in list(pool.keys())
+                    if num not in required or service_info is None or pool[num][1] != service_info["image"]
+                ]
+                missing = sorted(required - set(pool.keys()))
+
+            for container_name in stale:
+                self._remove_warm(container_name)
+            if len(missing) > 0:
+                self.submit(self.OP_WARM, service, missing, service_info=service_info)
+        except Exception as e:
+            logging.exception(e)
 
     def stop(self, service):
-        for i in range(1, self.list()[service].get("scale", 1) + 1):
-            try:
-                self.kernel.docker.stop(container=self.service_name(service, i), timeout=1)
-                logging.info("'%s'[%i] service stopped" % (service, i))
-            except:
-                logging.exception("Error stopping service '%s'[%i]" % (service, i))
+        service_info = self.list()[service]
+        instances = range(1, service_info.get("scale", 1) + 1)
+        return self.wait(self.submit(self.OP_STOP, service, instances, service_info=service_info))
+
+    def _stop(self, service, num, service_info):
+        self._stopping.add((service, num))
+        self.kernel.docker.stop(container=self.service_name(service, num), timeout=1)
+        self.index_update(service, num, state=self.STATE_EXITED)
+        logging.info("'%s'[%i] service stopped" % (service, num))
+
+    def stop_all(self):
+        """
+        Stop all services of the node at once
+        """
+        futures = []
+        for service, service_info in self.list().items():
+            instances = range(1, service_info.get("scale", 1) + 1)
+            futures.extend(self.submit(self.OP_STOP, service, instances, service_info=service_info))
+        return self.wait(futures)
 
     def add(self, service, image, permissions):
         if self.is_service(service):
             raise CollisionException
 
-        self.kernel.l.set(
-            "kernel/services",
-            keys={
-                service: {
-                    "image": image,
-                    "permissions": permissions,
-                    "token": self.generate_token(),
-                    "scale": 1,
-                    "command": None,
-                }
-            },
-        )
+        self.save(service, {
+            "image": image,
+            "permissions": permissions,
+            "token": self.generate_token(),
+            "scale": 1,
+            "command": None,
+        })
 
     def remove(self, service):
         if not self.is_service(service):
             raise ServiceNotFoundException
 
-        self.stop(service)
-        for i in range(1, self.list()[service].get("scale", 1) + 1):
-            try:
-                self.kernel.docker.remove_container(container=self.service_name(service, i), force=True)
-                logging.info("'%s'[%i] service removed" % (service, i))
-            except:
-                logging.exception("Error removing service '%s'[%i]" % (service, i))
+        service_info = self.list()[service]
+        instances = range(1, service_info.get("scale", 1) + 1)
+        return self.wait(self.submit(self.OP_REMOVE, service, instances, True, service_info=service_info))
+
+    def _remove(self, service, num, service_info, force):
+        container_name = self.service_name(service, num)
+        self._stopping.add((service, num))
+        try:
+            self.kernel.docker.stop(container=container_name, timeout=1)
+        except:
+            logging.exception("Error stopping service '%s'[%i]" % (service, num))
+        self.kernel.docker.remove_container(container=container_name, force=force)
+        self.index_update(service, num)
+        logging.info("'%s'[%i] service removed" % (service, num))
 
     def scale(self, service, num, force=None):
+        """
+        Scale service to the number of instances
+        Only missing instances are started and only the ones above the scale are removed
+        :return: list of operation results
+        """
         if not self.is_service(service):
             raise ServiceNotFoundException
 
+        num = int(num)
         force = True if force is None else bool(force)
 
-        service_status = self.kernel.docker.containers(
-            filters={
-                "label": "Service=\"%s\" CRAFTEngine=True" % service
-            },
-        )
+        service_info = self.list()[service]
+        service_info["scale"] = num
+        # Saved first: new instances have to pass the scale check when they connect
+        self.save(service, service_info)
 
-        if len(service_status) > num:
-            for scale_i in range(num + 1, service_status + 1):
-                try:
-                    self.kernel.docker.remove_container(container=self.service_name(service, scale_i), force=force)
-                except:
-                    pass
+        instances = self.index(service)
+        running = set(i for i, c in instances.items() if c["state"] == self.STATE_RUNNING)
+        required = set(range(1, num + 1))
 
-        elif len(service_status) < num:
-            for scale_i in range(service_status + 1, num + 1):
-                self._start(service, scale_i, force, True)
+        futures = self.submit(self.OP_START, service, sorted(required - running), force, True, service_info=service_info)
+        futures += self.submit(
+            self.OP_REMOVE, service, sorted(i for i in instances.keys() if i > num), force, service_info=service_info,
+        )
+        results = self.wait(futures)
+        self.refill(service)
+        return results
 
     def generate_token(self):
         # TODO: generate token
         return "TOKEN"
+
+    def exit(self, *args, **kwargs):
+        super().exit(*args, **kwargs)
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+__author__ = "Alexey Kachalov"
+
+import bisect
+import itertools
+import logging
+import socket
+import threading
+
+from craftengine.modules import KernelModule
+
+
+class Histogram(object):
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimate quantile
+        :param q: quantile in range (0, 1]
+        :return: upper bound of the bucket the quantile falls into or None
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else float("inf")
+
+    def dump(self):
+        return {
+            "buckets": list(zip(self.BUCKETS + (float("inf"),), self.counts)),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class RouteStats(object):
+    __slots__ = ("name", "requests", "errors", "rejected", "hedged", "retried", "coalesced", "in_flight", "latency")
+
+    def __init__(self, name):
+        self.name = name
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.hedged = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.in_flight = 0
+        self.latency = Histogram()
+
+    def dump(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "hedged": self.hedged,
+            "retried": self.retried,
+            "coalesced": self.coalesced,
+            "in_flight": self.in_flight,
+            "latency": self.latency.dump(),
+        }
+
+
+class ConnectionStats(object):
+    __slots__ = ("bytes_in", "bytes_out", "frames_in", "frames_out")
+
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+
+    def dump(self):
+        return {
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "frames_in": self.frames_in,
+            "frames_out": self.frames_out,
+        }
+
+
+class MeteredSocket(object):
+    """
+    Socket wrapper counting transferred bytes
+    """
+
+    # Corked data is written once it reaches either limit, larger writes bypass it
+    CORK_BYTES = 65536
+    CORK_BUFFERS = 256
+
+    __slots__ = ("_sock", "_stats", "_corked", "_corked_size")
+
+    def __init__(self, sock, stats):
+        self._sock = sock
+        self._stats = stats
+        self._corked = None
+        self._corked_size = 0
+
+    def __getattr__(self, item):
+        return getattr(self._sock, item)
+
+    def recv(self, *args, **kwargs):
+        data = self._sock.recv(*args, **kwargs)
+        self._stats.bytes_in += len(data)
+        return data
+
+    def recv_into(self, *args, **kwargs):
+        size = self._sock.recv_into(*args, **kwargs)
+        self._stats.bytes_in += size
+        return size
+
+    def send(self, data, *args, **kwargs):
+        if self._corked is not None:
+            self._cork(data)
+            return len(data)
+        size = self._sock.send(data, *args, **kwargs)
+        self._stats.bytes_out += size
+        return size
+
+    def sendall(self, data, *args, **kwargs):
+        if self._corked is not None:
+            self._cork(data)
+            return
+        self._sock.sendall(data, *args, **kwargs)
+        self._stats.bytes_out += len(data)
+
+    def readable(self):
+        """
+        Data can be read without blocking
+        """
+        try:
+            return len(self._sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)) > 0
+        except (BlockingIOError, InterruptedError):
+            return False
+
+    def cork(self):
+        """
+        Collect sent data until uncork, so several frames go out in one write
+        """
+        if self._corked is None:
+            self._corked = []
+
+    def uncork(self):
+        self._flush()
+        self._corked = None
+
+    def _cork(self, data):
+        if len(data) >= self.CORK_BYTES:
+            self._flush()
+            self._sock.sendall(data)
+            self._stats.bytes_out += len(data)
+            return
+
+        # Only mutable buffers are copied, the caller may reuse them
+        self._corked.append(data if isinstance(data, bytes) else bytes(data))
+        self._corked_size += len(data)
+        if self._corked_size >= self.CORK_BYTES or len(self._corked) >= self.CORK_BUFFERS:
+            self._flush()
+
+    def _flush(self):
+        """
+        Write corked buffers with scatter-gather writes, without joining them
+        """
+        buffers, self._corked, self._corked_size = self._corked, [], 0
+        while buffers:
+            sent = self._sock.sendmsg(buffers)
+            self._stats.bytes_out += sent
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if sent > 0:
+                buffers[0] = memoryview(buffers[0])[sent:]
+
+
+class Stats(KernelModule):
+    # Method names come from callers, routes above the limit share one entry
+    MAX_ROUTES = 1024
+    OTHER = "__other__"
+
+    _routes = None
+    _http = None
+
+    polls = 0
+    events = 0
+    loop = None
+
+    def init(self, *args, **kwargs):
+        self._routes = {}
+        self.polls = 0
+        self.events = 0
+        self.loop = Histogram()
+
+    def route(self, service, method):
+        key = service, method
+        try:
+            return self._routes[key]
+        except KeyError:
+            pass
+        if len(self._routes) >= self.MAX_ROUTES:
+            key = self.OTHER, self.OTHER
+            route = self._routes.get(key)
+            if route is not None:
+                return route
+        route = self._routes[key] = RouteStats("%s.%s" % key)
+        return route
+
+    @staticmethod
+    def label(value):
+        """
+        Label value escaped for Prometheus text format
+        """
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    def loop_iteration(self, events, duration):
+        self.polls += 1
+        self.events += events
+        self.loop.observe(duration)
+
+    def snapshot(self):
+        routes = {}
+        for (service, method), route in list(self._routes.items()):
+            routes.setdefault(service, {})[method] = route.dump()
+
+        connections = {}
+        for fn, sock_info in self.kernel.rpc.router.sockets():
+            connection = sock_info["stats"].dump()
+            connection["queue"] = len(sock_info["send_data"])
+            connection["type"] = sock_info["type"]
+            connection["address"] = sock_info["address"]
+            connections[fn] = connection
+
+        return {
+            "routes": routes,
+            "connections": connections,
+            "loop": {
+                "polls": self.polls,
+                "events": self.events,
+                "iteration": self.loop.dump(),
+            },
+        }
+
+    def prometheus(self):
+        lines = []
+
+        def histogram(name, h, labels):
+            for le, c in zip(Histogram.BUCKETS + ("+Inf",), itertools.accumulate(h.counts)):
+                lines.append("%s_bucket{%sle=\"%s\"} %i" % (name, labels, le, c))
+            lines.append("%s_sum{%s} %f" % (name, labels.rstrip(","), h.sum))
+            lines.append("%s_count{%s} %i" % (name, labels.rstrip(","), h.count))
+
+        for (service, method), route in list(self._routes.items()):
+            labels = "service=\"%s\",method=\"%s\"," % (self.label(service), self.label(method))
+            lines.append("ce_rpc_requests_total{%s} %i" % (labels[:-1], route.requests))
+            lines.append("ce_rpc_errors_total{%s} %i" % (labels[:-1], route.errors))
+            lines.append("ce_rpc_rejected_total{%s} %i" % (labels[:-1], route.rejected))
+            lines.append("ce_rpc_hedged_total{%s} %i" % (labels[:-1], route.hedged))
+            lines.append("ce_rpc_retried_total{%s} %i" % (labels[:-1], route.retried))
+            lines.append("ce_rpc_coalesced_total{%s} %i" % (labels[:-1], route.coalesced))
+            lines.append("ce_rpc_in_flight{%s} %i" % (labels[:-1], route.in_flight))
+            histogram("ce_rpc_response_seconds", route.latency, labels)
+
+        for fn, sock_info in self.kernel.rpc.router.sockets():
+            labels = "fn=\"%i\"" % fn
+            connection = sock_info["stats"]
+            lines.append("ce_conn_bytes_in_total{%s} %i" % (labels, connection.bytes_in))
+            lines.append("ce_conn_bytes_out_total{%s} %i" % (labels, connection.bytes_out))
+            lines.append("ce_conn_frames_in_total{%s} %i" % (labels, connection.frames_in))
+            lines.append("ce_conn_frames_out_total{%s} %i" % (labels, connection.frames_out))
+            lines.append("ce_conn_queue{%s} %i" % (labels, len(sock_info["send_data"])))
+
+        lines.append("ce_loop_polls_total %i" % self.polls)
+        lines.append("ce_loop_events_total %i" % self.events)
+        histogram("ce_loop_iteration_seconds", self.loop, "")
+        return "\n".join(lines) + "\n"
+
+    def serve_http(self, host, port):
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        stats = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = stats.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._http = HTTPServer((host, int(port)), Handler)
+        threading.Thread(target=self._http.serve_forever, name="kernel.stats", daemon=True).start()
+        logging.info("Metrics endpoint started (%s:%i)" % (host, int(port)))
+
+    def exit(self, *args, **kwargs):
+        super().exit(*args, **kwargs)
+        if self._http is not None:
+            self._http.shutdown()
+
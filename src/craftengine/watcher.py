@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+__author__ = "Alexey Kachalov"
+
+import logging
+import threading
+import time
+
+from craftengine.modules import KernelModule
+
+
+class Watcher(KernelModule):
+    """
+    Follows Docker events of this node's service containers
+    """
+
+    EVENT_STATE = "kernel.service.state"
+
+    POLICY_ALWAYS = "always"
+    POLICY_ON_FAILURE = "on-failure"
+
+    STATE_CREATED = "created"
+    STATE_RUNNING = "running"
+    STATE_EXITED = "exited"
+    STATE_RESTARTING = "restarting"
+    STATE_REMOVED = "removed"
+
+    ACTIONS = {
+        "create": STATE_CREATED,
+        "start": STATE_RUNNING,
+        "restart": STATE_RUNNING,
+        "die": STATE_EXITED,
+        "destroy": STATE_REMOVED,
+    }
+
+    # service -> {instance: {"id", "state", "since", "exit_code", "oom", "restarts"}}
+    _states = None
+    # (service, instance) -> restarts in a row, containers of an instance are replaced on each restart
+    _restarts = None
+    _lock = None
+    _since = None
+
+    def init(self, *args, **kwargs):
+        self._states = {}
+        self._restarts = {}
+        self._lock = threading.Lock()
+        self._since = None
+
+    def serve(self):
+        threading.Thread(target=self._watch, name="kernel.watcher", daemon=True).start()
+
+    def _watch(self):
+        while self.alive:
+            try:
+                events = self.kernel.docker.events(
+                    since=self._since,
+                    filters={
+                        "type": "container",
+                        "label": ["CRAFTEngine=True", "Node=%s" % self.kernel.env["CE_NODE_NAME"]],
+                    },
+                    decode=True,
+                )
+                for event in events:
+                    if not self.alive:
+                        return
+                    self._since = event.get("time", self._since)
+                    self.process(event)
+            except Exception as e:
+                logging.exception(e)
+            if self.alive:
+                time.sleep(1)
+
+    def process(self, event):
+        self.kernel.service.index_event(event)
+
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        instance = self.kernel.service.identify(attributes, attributes.get("name", ""))
+        if instance is None:
+            return
+        service, num = instance
+        action = event.get("Action", event.get("status"))
+
+        with self._lock:
+            state = self._states.setdefault(service, {}).setdefault(num, {
+                "id": None,
+                "state": None,
+                "since": None,
+                "exit_code": None,
+                "oom": False,
+                "restarts": self._restarts.get((service, num), 0),
+            })
+            if action == "oom":
+                state["oom"] = True
+                return
+            if action not in self.ACTIONS:
+                return
+            if action in ["die", "destroy"] and state["id"] not in [None, event.get("id")]:
+                # Replaced container of the instance
+                return
+
+            previous = state["state"], state["since"]
+            state["id"] = event.get("id")
+            state["state"] = self.ACTIONS[action]
+            state["since"] = event.get("time")
+            if action == "start":
+                state["oom"] = False
+            elif action == "die":
+                state["exit_code"] = int(attributes.get("exitCode", -1))
+            elif action == "destroy":
+                del self._states[service][num]
+            state = dict(state)
+
+        logging.info("'%s'[%i] service %s" % (service, num, state["state"]))
+        self.kernel.event.initiate(self.EVENT_STATE, {
+            "service": service,
+            "instance": num,
+            "state": state,
+        }, namespace=self.kernel.event.N_LOCAL)
+
+        if action == "die":
+            self._restart(service, num, state, previous)
+
+    def _restart(self, service, num, state, previous):
+        if self.kernel.service.is_stopping(service, num):
+            return
+        # Container removed while the instance has been started again
+        if not self.kernel.service.is_current(service, num, state["id"]):
+            return
+
+        service_info = self.kernel.service.list().get(service)
+        if service_info is None or num > service_info.get("scale", 1):
+            return
+
+        policy = service_info.get("restart") or {}
+        if policy.get("policy") == self.POLICY_ALWAYS:
+            pass
+        elif policy.get("policy") == self.POLICY_ON_FAILURE and (state["exit_code"] != 0 or state["oom"]):
+            pass
+        else:
+            return
+
+        backoff = float(policy.get("backoff", 1))
+        max_backoff = float(policy.get("max_backoff", 60))
+        with self._lock:
+            restarts = self._restarts.get((service, num), 0)
+        # Instance that has been running long enough is considered healthy again
+        if previous[0] == self.STATE_RUNNING and previous[1] is not None and state["since"] - previous[1] > max_backoff:
+            restarts = 0
+        delay = min(backoff * 2 ** restarts, max_backoff)
+
+        with self._lock:
+            self._restarts[service, num] = restarts + 1
+            try:
+                self._states[service][num]["restarts"] = restarts + 1
+                self._states[service][num]["state"] = self.STATE_RESTARTING
+            except KeyError:
+                pass
+
+        logging.warning("'%s'[%i] service died (%s), restarting in %.1fs" % (
+            service, num, "OOM" if state["oom"] else "exit code %s" % state["exit_code"], delay,
+        ))
+        timer = threading.Timer(delay, self.kernel.service.submit, (self.kernel.service.OP_START, service, [num], True, True))
+        timer.daemon = True
+        timer.start()
+
+    def states(self, service=None):
+        """
+        State table of services on this node
+        :param service: service name
+        """
+        with self._lock:
+            if service is None:
+                return {k: {i: dict(s) for i, s in v.items()} for k, v in self._states.items()}
+            return {i: dict(s) for i, s in self._states.get(service, {}).items()}
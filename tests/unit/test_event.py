@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+__author__ = "Alexey Kachalov"
+
+import unittest
+
+from craftengine.event import Subscriptions
+
+
+class SubscriptionsTest(unittest.TestCase):
+    def setUp(self):
+        self.subscriptions = Subscriptions()
+
+    def matched(self, name):
+        return sorted(self.subscriptions.match(name))
+
+    def test_exact(self):
+        self.subscriptions.add("player.join", 1, "join")
+        self.assertEqual(self.matched("player.join"), ["join"])
+        self.assertEqual(self.matched("player.quit"), [])
+        self.assertEqual(self.matched("player"), [])
+
+    def test_one_part(self):
+        self.subscriptions.add("player.*", 1, "player")
+        self.assertEqual(self.matched("player.join"), ["player"])
+        self.assertEqual(self.matched("player"), [])
+        self.assertEqual(self.matched("player.join.first"), [])
+
+    def test_any_parts(self):
+        self.subscriptions.add("player.**", 1, "player")
+        self.subscriptions.add("**", 2, "all")
+        self.assertEqual(self.matched("player"), ["all", "player"])
+        self.assertEqual(self.matched("player.join.first"), ["all", "player"])
+        self.assertEqual(self.matched("world.save"), ["all"])
+
+    def test_any_in_the_middle(self):
+        self.subscriptions.add("world.**.save", 1, "save")
+        self.assertEqual(self.matched("world.save"), ["save"])
+        self.assertEqual(self.matched("world.chunk.1.save"), ["save"])
+        self.assertEqual(self.matched("world.chunk.load"), [])
+
+    def test_matched_once(self):
+        self.subscriptions.add("**.join", 1, "join")
+        self.assertEqual(self.matched("join.join.join"), ["join"])
+
+    def test_remove(self):
+        self.subscriptions.add("player.*", 1, "player")
+        self.assertEqual(self.matched("player.join"), ["player"])
+        self.subscriptions.remove("player.*", 1)
+        # Cached match is dropped along with the callback
+        self.assertEqual(self.matched("player.join"), [])
+        # Branches left without callbacks are pruned
+        self.assertEqual(self.subscriptions.children, {})
+
+    def test_remove_keeps_other_branches(self):
+        self.subscriptions.add("player.*", 1, "player")
+        self.subscriptions.add("player.join", 2, "join")
+        self.subscriptions.remove("player.*", 1)
+        self.subscriptions.remove("world.*", 3)
+        self.assertEqual(self.matched("player.join"), ["join"])
+        self.assertIsNone(self.subscriptions.get("player.*"))
+        self.assertEqual(self.subscriptions.get("player.join"), {2: "join"})
+
+
+if __name__ == "__main__":
+    unittest.main()
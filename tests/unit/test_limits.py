@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+__author__ = "Alexey Kachalov"
+
+import unittest
+
+from craftengine.limits import Limits, RateLimitException, TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_full_on_creation(self):
+        bucket = TokenBucket(1, now=10.0)
+        self.assertTrue(bucket.refill(10.0))
+        self.assertEqual(bucket.tokens, 1.0)
+
+    def test_refill(self):
+        bucket = TokenBucket(2, burst=4, now=0.0)
+        bucket.tokens = 0
+        self.assertFalse(bucket.refill(0.25))
+        self.assertTrue(bucket.refill(0.5))
+        self.assertEqual(bucket.refill(10.0) and bucket.tokens, 4.0)
+
+
+class LimitsTest(unittest.TestCase):
+    def setUp(self):
+        self.limits = Limits()
+        self.limits.load({
+            "world": {"limits": {"rate": 1, "callers": {"*": {"rate": 100}}}},
+            "chat": {},
+        })
+
+    def admitted(self, caller, service, num):
+        count = 0
+        for _ in range(num):
+            try:
+                self.limits.admit(caller, service)
+            except RateLimitException:
+                pass
+            else:
+                count += 1
+        return count
+
+    def test_burst_admitted(self):
+        self.assertEqual(self.admitted("game", "world", 5), 1)
+
+    def test_unlimited(self):
+        self.assertEqual(self.admitted("game", "chat", 5), 5)
+
+    def test_load_keeps_buckets(self):
+        self.assertEqual(self.admitted("game", "world", 1), 1)
+        self.limits.load({"world": {"limits": {"rate": 1, "callers": {"*": {"rate": 100}}}}})
+        self.assertEqual(self.admitted("game", "world", 1), 0)
+
+    def test_update_resets_buckets(self):
+        self.assertEqual(self.admitted("game", "world", 1), 1)
+        self.limits.update("world", {"limits": {"rate": 2}})
+        self.assertEqual(self.admitted("game", "world", 3), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
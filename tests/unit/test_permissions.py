@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+__author__ = "Alexey Kachalov"
+
+import unittest
+
+from craftengine.permissions import Permissions, PermissionsException
+
+
+class HasPermissionTest(unittest.TestCase):
+    def setUp(self):
+        self.permissions = Permissions()
+
+    def test_exact(self):
+        self.assertTrue(self.permissions.has_permission(["registry.local.get"], ["registry.local.get"]))
+
+    def test_prefix_grants_subtree(self):
+        self.assertTrue(self.permissions.has_permission(["registry"], ["registry.local.get"]))
+
+    def test_wildcard_grants_subtree(self):
+        self.assertTrue(self.permissions.has_permission(["registry.*"], ["registry.local.get", "registry.global"]))
+        self.assertTrue(self.permissions.has_permission(["*"], ["kernel.env"]))
+
+    def test_subtree_does_not_grant_parent(self):
+        with self.assertRaises(PermissionsException):
+            self.permissions.has_permission(["registry.local"], ["registry"])
+
+    def test_sibling(self):
+        with self.assertRaises(PermissionsException):
+            self.permissions.has_permission(["registry.local.get"], ["registry.local.set"])
+
+    def test_every_required(self):
+        with self.assertRaises(PermissionsException):
+            self.permissions.has_permission(["kernel.env"], ["kernel.env", "kernel.stats"])
+
+    def test_compiled_cache(self):
+        self.assertIs(self.permissions.compile(["a.b", "c"]), self.permissions.compile(["a.b", "c"]))
+
+
+class AuthorizeTest(unittest.TestCase):
+    def setUp(self):
+        self.permissions = Permissions()
+        self.permissions.load({
+            "world": {"protected": True},
+            "chat": {},
+            "game": {"permissions": ["service.world.get"]},
+            "admin": {"permissions": ["service.*"]},
+        })
+
+    def test_unprotected(self):
+        self.assertIsNone(self.permissions.authorize("nobody", "chat", "send"))
+
+    def test_granted(self):
+        self.permissions.authorize("game", "world", "get")
+        self.permissions.authorize("admin", "world", "set")
+
+    def test_denied(self):
+        with self.assertRaises(PermissionsException):
+            self.permissions.authorize("game", "world", "set")
+        with self.assertRaises(PermissionsException):
+            self.permissions.authorize("chat", "world", "get")
+
+    def test_remote_caller(self):
+        self.permissions.authorize("remote", "world", "get", ["service.world.get"])
+        with self.assertRaises(PermissionsException):
+            self.permissions.authorize("remote", "world", "get", [])
+
+    def test_update(self):
+        self.permissions.update("chat", {"protected": True})
+        with self.assertRaises(PermissionsException):
+            self.permissions.authorize("game", "chat", "send")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+__author__ = "Alexey Kachalov"
+
+import types
+import unittest
+
+from craftengine.rpc import Router, SendQueue
+
+
+class SendQueueTest(unittest.TestCase):
+    def setUp(self):
+        # Only the priority of the frame being processed is read from the router
+        self.router = types.SimpleNamespace(priority=Router.PRIORITY_NORMAL)
+        self.queue = SendQueue(self.router)
+
+    def fill(self, num):
+        for priority in [Router.PRIORITY_REALTIME, Router.PRIORITY_NORMAL, Router.PRIORITY_BATCH]:
+            self.queue.extend([(priority, i) for i in range(num)], priority)
+
+    def drain(self):
+        frames = []
+        while len(self.queue) > 0:
+            frames.append(self.queue.popleft())
+        return frames
+
+    def test_weights(self):
+        self.fill(20)
+        classes = [priority for priority, _ in self.drain()[:26]]
+        self.assertEqual(classes, [0] * 8 + [1] * 4 + [2] + [0] * 8 + [1] * 4 + [2])
+
+    def test_order_in_class(self):
+        self.fill(10)
+        frames = self.drain()
+        for priority in range(3):
+            self.assertEqual([i for p, i in frames if p == priority], list(range(10)))
+
+    def test_empty_classes_skipped(self):
+        self.queue.extend(["a", "b"], Router.PRIORITY_BATCH)
+        self.queue.append("c", Router.PRIORITY_REALTIME)
+        self.assertEqual(self.queue.peek(), "c")
+        self.assertEqual(self.drain(), ["c", "a", "b"])
+
+    def test_default_priority(self):
+        self.router.priority = Router.PRIORITY_BATCH
+        self.queue.append("batch")
+        self.router.priority = Router.PRIORITY_REALTIME
+        self.queue.append("realtime")
+        self.assertEqual(list(self.queue.queues[Router.PRIORITY_BATCH]), ["batch"])
+        self.assertEqual(self.drain(), ["realtime", "batch"])
+
+    def test_merge(self):
+        other = SendQueue(self.router)
+        other.append("old", Router.PRIORITY_NORMAL)
+        self.queue.append("new", Router.PRIORITY_NORMAL)
+        other.merge(self.queue)
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(list(other), ["old", "new"])
+
+
+if __name__ == "__main__":
+    unittest.main()